@@ -0,0 +1,189 @@
+"""
+Complete results from ArcGIS REST API layer queries.
+
+A query returns at most the layer's maxRecordCount features, and sets
+exceededTransferLimit when there were more. When that happens LayerQuery
+asks for just the object ids matching the query - which that limit doesn't
+apply to - then fetches the features in batches of page_size consecutive
+ids, each one a where clause on a range of object ids, max_workers batches
+at a time. Features come back in object id order.
+
+It can also look up a layer's metadata, e.g. the editFieldsInfo of layers
+with editor tracking, and fetch features by a list of object ids.
+
+https://developers.arcgis.com/rest/services-reference/query-feature-service-layer-.htm
+"""
+from http_client import default_client
+from multiprocessing.pool import ThreadPool
+import time
+import urllib
+import urlparse
+
+
+class ArcGisError(Exception):
+    pass
+
+
+class LayerQuery(object):
+    page_size = 1000
+    max_workers = 4
+    # We do our own paging, so these are dropped from the query url
+    paging_params = ('resultOffset', 'resultRecordCount')
+
+    def __init__(self, url, http=None, page_size=None, max_workers=None):
+        parts = urlparse.urlsplit(url)
+        self.base_url = urlparse.urlunsplit(parts[:3] + ('', ''))
+        self.params = [
+            (name, value)
+            for name, value in urlparse.parse_qsl(parts.query, True)
+            if name not in self.paging_params
+        ]
+        self.http = http or default_client()
+        if page_size is not None:
+            self.page_size = page_size
+        if max_workers is not None:
+            self.max_workers = max_workers
+
+    def url(self, **params):
+        "The query url, with params replacing any of the same name"
+        return self.base_url + '?' + urllib.urlencode(
+            replace_params(self.params, params)
+        )
+
+    def update(self, **params):
+        "Replaces or adds query parameters, e.g. outFields"
+        self.params = replace_params(self.params, params)
+
+    def get(self, url):
+        return check(self.http.get(url).json())
+
+    def layer_info(self):
+        "The layer's metadata - its fields, editFieldsInfo and so on"
+        layer_url = self.base_url.rstrip('/')
+        if layer_url.endswith('/query'):
+            layer_url = layer_url[:-len('/query')]
+        return self.get(layer_url + '?f=json')
+
+    def where(self, condition=None):
+        "The query's where clause, narrowed down by condition"
+        original = dict(self.params).get('where')
+        if not condition:
+            return original
+        if original:
+            return '(%s) AND %s' % (original, condition)
+        return condition
+
+    def features(self, first=None, where=None):
+        """
+        Every feature matching the query, and where if given. first is the
+        response to url(), if the caller has already fetched it.
+        """
+        if first is None:
+            first = self.get(self.url(where=self.where(where)))
+        first = check(first)
+        if not first.get('exceededTransferLimit'):
+            return first['features']
+        field, object_ids = self.object_ids(where)
+        batches = [
+            object_ids[i:i + self.page_size]
+            for i in range(0, len(object_ids), self.page_size)
+        ]
+        return self.in_parallel(
+            lambda batch: self.batch(field, batch, where), batches, field
+        )
+
+    def object_ids(self, where=None):
+        "(object id field name, sorted object ids) for the matching features"
+        data = self.get(self.url(where=self.where(where), returnIdsOnly='true'))
+        return data['objectIdFieldName'], sorted(data.get('objectIds') or [])
+
+    def features_by_id(self, field, object_ids):
+        "The features with these object ids, whether or not they match"
+        object_ids = sorted(object_ids)
+        batches = [
+            object_ids[i:i + self.page_size]
+            for i in range(0, len(object_ids), self.page_size)
+        ]
+
+        def fetch(batch):
+            return self.get(self.base_url + '?' + urllib.urlencode(
+                replace_params(self.params, {
+                    'objectIds': ','.join(map(str, batch)),
+                }, drop=('where', 'geometry'))
+            ))['features']
+
+        return self.in_parallel(fetch, batches, field)
+
+    def in_parallel(self, fetch, batches, field):
+        "Calls fetch for each batch, max_workers at a time, merging by id"
+        if not batches:
+            return []
+        pool = ThreadPool(max(1, min(self.max_workers, len(batches))))
+        try:
+            pages = pool.map(fetch, batches)
+        finally:
+            pool.close()
+        features = [feature for page in pages for feature in page]
+        features.sort(key=lambda feature: feature['attributes'].get(field))
+        return features
+
+    def batch(self, field, object_ids, where=None):
+        "The matching features whose ids are within the range of object_ids"
+        condition = '%s >= %d AND %s <= %d' % (
+            field, object_ids[0], field, object_ids[-1]
+        )
+        if where:
+            condition = '%s AND %s' % (where, condition)
+        data = self.get(self.url(where=self.where(condition)))
+        if data.get('exceededTransferLimit') and len(object_ids) > 1:
+            # page_size is more than the server will return in one go
+            middle = len(object_ids) // 2
+            return (
+                self.batch(field, object_ids[:middle], where) +
+                self.batch(field, object_ids[middle:], where)
+            )
+        return data['features']
+
+
+def replace_params(params, replacements, drop=()):
+    "params is a list of (name, value) pairs, replacements a dict"
+    replaced = [
+        (name, value) for name, value in params
+        if name not in replacements and name not in drop
+    ]
+    replaced.extend(sorted(
+        (name, value) for name, value in replacements.items()
+        if value is not None
+    ))
+    return replaced
+
+
+def object_id_field(layer_info):
+    if layer_info.get('objectIdField'):
+        return layer_info['objectIdField']
+    for field in layer_info.get('fields') or []:
+        if field.get('type') == 'esriFieldTypeOID':
+            return field['name']
+    return None
+
+
+def edit_date_field(layer_info):
+    "The field editor tracking keeps last edit times in, if there is one"
+    return (layer_info.get('editFieldsInfo') or {}).get('editDateField')
+
+
+def timestamp(milliseconds):
+    "A where clause literal for an ArcGIS date, which is in ms since 1970"
+    return "timestamp '%s'" % time.strftime(
+        '%Y-%m-%d %H:%M:%S', time.gmtime(milliseconds / 1000)
+    )
+
+
+def check(data):
+    "Errors come back as a 200 response with an 'error' object"
+    if 'error' in data:
+        error = data['error']
+        raise ArcGisError('%s: %s' % (
+            error.get('code'), error.get('message')
+        ))
+    return data
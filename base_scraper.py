@@ -1,4 +1,6 @@
 from common import Scraper
+from diff import diff_records
+from operator import itemgetter
 
 
 class BaseScraper(Scraper):
@@ -18,6 +20,9 @@ class BaseDeltaScraper(BaseScraper):
     should have a key that can be used to identify the row in that dict.
 
     Then you define a display_record(record) method that returns a string.
+    If show_changes is True, display_changes(old_record, new_record, fields)
+    is used to render records that differ - fields is the list of keys whose
+    values changed.
     """
     record_key = None
     show_changes = False
@@ -33,59 +38,53 @@ class BaseDeltaScraper(BaseScraper):
     def noun_plural(self):
         return self.noun + 's'
 
+    def display_changes(self, old_record, new_record, fields):
+        display = []
+        display.append('  %s' % new_record[self.record_key])
+        for field in fields:
+            display.append('    %s: %s -> %s' % (
+                field, old_record.get(field), new_record.get(field)
+            ))
+        display.append('')
+        return '\n'.join(display)
+
     def create_message(self, new_records):
         return self.update_message([], new_records, 'Created')
 
     def update_message(self, old_records, new_records, verb='Updated'):
-        previous_ids = [
-            record[self.record_key] for record in old_records
-        ]
-        current_ids = [
-            record[self.record_key] for record in new_records
-        ]
-        added_ids = [id for id in current_ids if id not in previous_ids]
-        removed_ids = [id for id in previous_ids if id not in current_ids]
+        diff = diff_records(
+            old_records, new_records, key=itemgetter(self.record_key)
+        )
 
         message_blocks = []
-        if added_ids:
+        if diff.added:
             messages = []
             messages.append('%d new %s:' % (
-                len(added_ids), self.noun if len(added_ids) == 1 else self.noun_plural
+                len(diff.added), self.noun if len(diff.added) == 1 else self.noun_plural
             ))
-            for id in added_ids:
-                record = [r for r in new_records if r[self.record_key] == id][0]
+            for record in diff.added:
                 messages.append(self.display_record(record))
             message_blocks.append(messages)
 
-        if removed_ids:
+        if diff.removed:
             messages = []
             messages.append('%d %s removed:' % (
-                len(removed_ids), self.noun if len(removed_ids) == 1 else self.noun_plural
+                len(diff.removed), self.noun if len(diff.removed) == 1 else self.noun_plural
             ))
-            for id in removed_ids:
-                record = [r for r in old_records if r[self.record_key] == id][0]
+            for record in diff.removed:
                 messages.append(self.display_record(record))
             message_blocks.append(messages)
 
         # Add useful rendering of CHANGED records as well
-        changed_records = []
-        for new_record in new_records:
-            try:
-                old_record = [
-                    r for r in old_records
-                    if r[self.record_key] == new_record[self.record_key]
-                ][0]
-            except IndexError:
-                continue
-            changed_records.append((old_record, new_record))
-
-        if self.show_changes and changed_records:
+        if self.show_changes and diff.changed:
             messages = []
             messages.append('%d %s changed:' % (
-                len(removed_ids), self.noun if len(removed_ids) == 1 else self.noun_plural
+                len(diff.changed), self.noun if len(diff.changed) == 1 else self.noun_plural
             ))
-            for old_record, new_record in changed_records:
-                messages.append(self.display_changes(old_record, new_record))
+            for old_record, new_record, fields in diff.changed:
+                messages.append(
+                    self.display_changes(old_record, new_record, fields)
+                )
             message_blocks.append(messages)
 
         blocks = []
@@ -99,17 +98,17 @@ class BaseDeltaScraper(BaseScraper):
         body = '\n\n'.join(blocks)
 
         summary = []
-        if added_ids:
+        if diff.added:
             summary.append('%d %s added' % (
-                len(added_ids), self.noun if len(added_ids) == 1 else self.noun_plural
+                len(diff.added), self.noun if len(diff.added) == 1 else self.noun_plural
             ))
-        if removed_ids:
+        if diff.removed:
             summary.append('%d %s removed' % (
-                len(removed_ids), self.noun if len(removed_ids) == 1 else self.noun_plural
+                len(diff.removed), self.noun if len(diff.removed) == 1 else self.noun_plural
             ))
-        if changed_records:
+        if diff.changed:
             summary.append('%d %s changed' % (
-                len(changed_records), self.noun if len(changed_records) == 1 else self.noun_plural
+                len(diff.changed), self.noun if len(diff.changed) == 1 else self.noun_plural
             ))
         if summary:
             summary_text = self.display_name + ': ' + (', '.join(summary))
@@ -0,0 +1,212 @@
+"""
+Rough benchmarks for the expensive parts of the scrapers, run against
+synthetic data so they need no network access:
+
+    python benchmarks.py            # run them all
+    python benchmarks.py dupes      # run the ones with "dupes" in the name
+"""
+from irma import FloridaDisasterShelters
+from irma_shelters import IrmaShelterDupes, IrmaSheltersFloridaMissing
+from BeautifulSoup import BeautifulSoup as Soup
+import random
+import sys
+import time
+
+
+def timed(fn, *args):
+    start = time.time()
+    fn(*args)
+    return time.time() - start
+
+
+def report(name, sizes, timings):
+    print name
+    for size, timing in zip(sizes, timings):
+        print '  %6d records: %8.1fms (%.2fus per record)' % (
+            size, timing * 1000, timing * 1000000 / size
+        )
+
+
+def dupes_data(num_shelters, seed):
+    random.seed(seed)
+    groups = []
+    for i in range(0, num_shelters, 2):
+        groups.append({
+            'geohash': 'dhv%04x' % (i + random.randint(0, 1)),
+            'shelters': [{
+                'id': i + j,
+                'name': 'Shelter %d' % (i + j),
+                'address': '%d Main Street' % (i + j),
+                'google_maps': 'https://www.google.com/maps/search/26.1,-80.1',
+                'view_url': 'https://irma-api.herokuapp.com/shelters/%d' % (i + j),
+            } for j in range(2)],
+        })
+    no_latlons = [{
+        'id': i,
+        'name': 'Shelter %d' % i,
+        'address': '',
+        'view_url': 'https://irma-api.herokuapp.com/shelters/%d' % i,
+    } for i in range(0, num_shelters, 10) if random.random() > 0.1]
+    return {
+        'dupe_groups': groups,
+        'no_latitude_longitude': no_latlons,
+    }
+
+
+def bench_dupes_update_message():
+    scraper = IrmaShelterDupes(None)
+    sizes = (1000, 10000, 20000, 40000)
+    timings = [
+        timed(
+            scraper.update_message,
+            dupes_data(size, seed=1),
+            dupes_data(size, seed=2),
+        )
+        for size in sizes
+    ]
+    report('IrmaShelterDupes.update_message', sizes, timings)
+
+
+def irma_api_shelters(num_shelters, seed):
+    random.seed(seed)
+    shelters = []
+    for i in range(num_shelters):
+        latitude = random.uniform(24.5, 31)
+        longitude = random.uniform(-87.5, -80)
+        if i % 10 == 9:
+            # Every tenth shelter is a near-duplicate, a few metres away
+            latitude = shelters[-1]['latitude'] + 0.0001
+            longitude = shelters[-1]['longitude']
+        shelters.append({
+            'id': i,
+            'shelter': 'Shelter %d' % i,
+            'address': '%d Main Street' % i,
+            'latitude': latitude,
+            'longitude': longitude,
+        })
+    return shelters
+
+
+def bench_dupes_find_dupes():
+    scraper = IrmaShelterDupes(None)
+    sizes = (1000, 10000, 40000)
+    timings = [
+        timed(scraper.find_dupes, irma_api_shelters(size, seed=1))
+        for size in sizes
+    ]
+    report('IrmaShelterDupes.find_dupes', sizes, timings)
+
+
+def missing_data(num_shelters, seed):
+    random.seed(seed)
+    return [{
+        'name': 'Shelter %d' % i,
+        'county': 'Miami-Dade',
+        'type': 'General',
+        'address': '%d Main Street' % i,
+        'city': 'Miami',
+        'map_url': 'http://maps.google.com/maps?saddr=&daddr=25.%06d,-80.1' % i,
+    } for i in range(num_shelters) if random.random() > 0.05]
+
+
+def bench_florida_missing_update_message():
+    scraper = IrmaSheltersFloridaMissing(None)
+    sizes = (1000, 10000, 20000, 40000)
+    timings = [
+        timed(
+            scraper.update_message,
+            missing_data(size, seed=1),
+            missing_data(size, seed=2),
+        )
+        for size in sizes
+    ]
+    report('IrmaSheltersFloridaMissing.update_message', sizes, timings)
+
+
+def florida_shelters_page(num_shelters):
+    "Mimics the layout of floridadisaster.org/shelters/summary.aspx"
+    html = ['<html><head><meta charset="utf-8"></head><body>']
+    html.extend(
+        '<table><tr><td>Layout %d</td></tr></table>' % i for i in range(9)
+    )
+    html.append('<table>')
+    for i in range(num_shelters):
+        if i % 50 == 0:
+            html.append(
+                '<tr><td colspan="5" style="background: #d4d4d4">'
+                'COUNTY %d</td></tr>' % (i / 50)
+            )
+            html.append(
+                '<tr><td>Type</td><td>Shelter Name</td><td>Address</td>'
+                '<td>City</td></tr>'
+            )
+        html.append(
+            '<tr><td>General</td><td>Shelter %d &amp; Annex</td>'
+            '<td><a href="http://maps.google.com/?daddr=25.%d,-80.1 x">'
+            '%d Main St</a></td><td> Miami&nbsp;</td></tr>' % (i, i, i)
+        )
+    html.append('</table></body></html>')
+    return ''.join(html)
+
+
+def florida_shelters_with_beautifulsoup(html):
+    "How FloridaDisasterShelters parsed the page before html_tables"
+    table = Soup(html).findAll('table')[9]
+    current_county = None
+    shelters = []
+    for tr in table.findAll('tr'):
+        td = tr.find('td')
+        if td.get('colspan') == '5' and tr.text != '&nbsp;':
+            current_county = tr.text
+        tds = tr.findAll('td')
+        if len(tds) == 4 and tds[1].text != 'Shelter Name':
+            shelters.append({
+                'type': tds[0].text,
+                'county': current_county.title(),
+                'name': tds[1].text,
+                'address': tds[2].text,
+                'map_url': tds[2].find('a')['href'].split(' ')[0],
+                'city': tds[3].text,
+            })
+    shelters.sort(key=lambda s: (s['county'], s['name']))
+    return shelters
+
+
+def bench_florida_shelters_parse():
+    scraper = FloridaDisasterShelters(None)
+    sizes = (100, 1000, 5000)
+    pages = [florida_shelters_page(size) for size in sizes]
+    report('BeautifulSoup 3', sizes, [
+        timed(florida_shelters_with_beautifulsoup, page) for page in pages
+    ])
+    report('FloridaDisasterShelters.parse_shelters', sizes, [
+        timed(scraper.parse_shelters, page) for page in pages
+    ])
+
+
+def bench_florida_missing_find_missing():
+    scraper = IrmaSheltersFloridaMissing(None)
+    sizes = (1000, 10000, 40000)
+    timings = []
+    for size in sizes:
+        ours = irma_api_shelters(size, seed=1)
+        for shelter in ours:
+            shelter['county'] = 'Miami-Dade'
+        # Theirs are ours, nudged a few metres, with every twentieth missing
+        theirs = [{
+            'name': shelter['shelter'],
+            'map_url': 'http://maps.google.com/maps?saddr=&daddr=%.6f,%.6f' % (
+                shelter['latitude'] + 0.0002, shelter['longitude'],
+            ),
+        } for shelter in ours]
+        del ours[::20]
+        timings.append(timed(scraper.find_missing, ours, theirs))
+    report('IrmaSheltersFloridaMissing.find_missing', sizes, timings)
+
+
+if __name__ == '__main__':
+    names = sorted(name for name in globals() if name.startswith('bench_'))
+    pattern = sys.argv[1] if len(sys.argv) > 1 else ''
+    for name in names:
+        if pattern in name:
+            globals()[name]()
@@ -1,7 +1,17 @@
 from github_read_write import GithubContent
+from records import RecordSet, json_default
+from serialization import SerializedContent
+from state import StateStore
+from http_client import (
+    NotModified,
+    conditional_headers,
+    default_client,
+    response_validators,
+)
 
-import requests
+import hashlib
 import json
+import tempfile
 
 
 class Scraper(object):
@@ -12,12 +22,51 @@ class Scraper(object):
     slack_channel = None
     slack_botname = None
     test_mode = False
+    # Bounds on how often the adaptive scheduler polls this scraper, in
+    # seconds - None means use the scheduler's defaults
+    min_interval = None
+    max_interval = None
+    # Set to True to skip parsing when the raw response bytes are unchanged
+    fingerprint = False
+    # Set to True for big lists of similar records, to hold them as a
+    # records.RecordSet rather than as plain dicts
+    compact_records = False
+    # Filepaths of other scrapers' outputs this one is derived from. When
+    # they run in the same CycleRunner it runs them first and hands their
+    # data over in self.inputs, see input()
+    depends_on = ()
 
-    def __init__(self, github_token, slack_token=None):
-        self.last_data = None
+    def __init__(self, github_token, slack_token=None, http=None, storage=None, state=None):
+        # Blob sha of the file as last committed - the data itself is only
+        # kept compressed in self.state, see previous_data()
         self.last_sha = None
         self.github_token = github_token
         self.slack_token = slack_token
+        self.http = http or default_client()
+        # Anything with GithubContent's read() / blob_sha() / write() /
+        # write_many() and NotFound, e.g. local_git.LocalGitRepository
+        self.storage = storage or GithubContent(
+            self.owner, self.repo, self.github_token, http=self.http
+        )
+        # A state.StateStore holding the last committed data, pass one with a
+        # directory to remember it across restarts
+        self.state = state or StateStore()
+        # Fingerprints of the raw responses we last stored data for
+        self._fingerprints = {}
+        # Validators and fingerprints from this run's fetches, only saved
+        # once it succeeds
+        self._pending_validators = {}
+        self._pending_fingerprints = {}
+        # Upstream data from the runner, keyed by filepath, and the blob sha
+        # of each - the versions are remembered once a run succeeds
+        self.inputs = {}
+        self.input_versions = {}
+        self._stored_input_versions = None
+        # The runner sets keep_output on scrapers others depend on, so the
+        # latest data and its blob sha stay available to them
+        self.keep_output = False
+        self.output = None
+        self.output_sha = None
 
     def post_to_slack(self, message, commit_hash):
         if not (self.slack_channel and self.slack_token):
@@ -27,19 +76,19 @@ class Scraper(object):
             body = message.split('\n', 1)[1]
         except IndexError:
             body = ''
-        github_url = 'https://github.com/%s/%s/commit/%s' % (
-            self.owner, self.repo, commit_hash
-        )
-        requests.post('https://slack.com/api/chat.postMessage', {
+        github_url = self.commit_url(commit_hash)
+        attachment = {
+            'fallback': github_url or headline,
+            'pretext': headline,
+            'title': '%s: %s' % (self.filepath, commit_hash[:8]),
+            'text': body.strip(),
+        }
+        if github_url:
+            attachment['title_link'] = github_url
+        self.http.post('https://slack.com/api/chat.postMessage', {
             'token': self.slack_token,
             'channel': self.slack_channel,
-            'attachments': json.dumps([{
-                'fallback': github_url,
-                'pretext': headline,
-                'title': '%s: %s' % (self.filepath, commit_hash[:8]),
-                'title_link': github_url,
-                'text': body.strip(),
-            }]),
+            'attachments': json.dumps([attachment]),
             'icon_emoji': ':robot_face:',
             'username': self.slack_botname,
         }).json()
@@ -53,56 +102,281 @@ class Scraper(object):
     def fetch_data(self):
         return []
 
-    def scrape_and_store(self):
-        data = self.fetch_data()
+    def fetch(self, url, method='GET', cache_key=None, **kwargs):
+        """
+        Makes a conditional request using the validators saved the last time
+        this scraper successfully stored its data. Raises NotModified if the
+        server responds with a 304 - or, if self.fingerprint is set, if the
+        (normalized) response body is byte-for-byte what we saw last time.
+
+        cache_key identifies the resource if url contains a cache-buster.
+        The response may be shared with other scrapers, so treat its json()
+        as read-only.
+        Pass stream=True to read response.raw yourself; fingerprints need
+        the whole body, so they don't mix with that - use fetch_file().
+        """
+        key = '%s %s' % (self.filepath, cache_key or url)
+        validators = self.http.validators.get(key)
+        if validators:
+            headers = dict(kwargs.pop('headers', None) or {})
+            headers.update(conditional_headers(validators))
+            kwargs['headers'] = headers
+        # Other scrapers fetching the same thing this cycle share the response
+        response = self.http.request(
+            method, url, shared=not kwargs.get('stream'), **kwargs
+        )
+        if response.status_code == 304:
+            response.close()
+            raise NotModified(url)
+        if response.status_code != 200:
+            return response
+        self._pending_validators[key] = response_validators(response)
+        if self.fingerprint and not kwargs.get('stream'):
+            self.check_fingerprint(key, url, hashlib.sha1(
+                self.normalize_content(response.content)
+            ).hexdigest())
+        return response
+
+    def discard_validators(self, url, cache_key=None):
+        "Makes the next fetch() of url unconditional, e.g. when it was partial"
+        self._pending_validators['%s %s' % (self.filepath, cache_key or url)] = {}
+
+    def fetch_file(self, url, method='GET', cache_key=None, **kwargs):
+        """
+        Like fetch(), but downloads the body into a temporary file a chunk at
+        a time and returns that file, for documents too big to want in
+        memory as one string. Fingerprints come from fingerprint_file().
+        """
+        response = self.fetch(
+            url, method=method, cache_key=cache_key, stream=True, **kwargs
+        )
+        try:
+            response.raise_for_status()
+            fp = tempfile.SpooledTemporaryFile(max_size=1024 * 1024)
+            for chunk in response.iter_content(64 * 1024):
+                fp.write(chunk)
+        finally:
+            response.close()
+        fp.seek(0)
+        if self.fingerprint:
+            key = '%s %s' % (self.filepath, cache_key or url)
+            try:
+                self.check_fingerprint(key, url, self.fingerprint_file(fp))
+            except NotModified:
+                fp.close()
+                raise
+            fp.seek(0)
+        return fp
+
+    def check_fingerprint(self, key, url, fingerprint):
+        self._pending_fingerprints[key] = fingerprint
+        if self._fingerprints.get(key) == fingerprint:
+            raise NotModified(url)
+
+    def normalize_content(self, content):
+        """
+        Override to strip volatile fragments - cache-busters, timestamps,
+        session tokens - that change without the data itself changing.
+        Only used to calculate fingerprints.
+        """
+        return content
+
+    def fingerprint_file(self, fp):
+        "The fingerprint of a file from fetch_file() - a sha1 of its bytes"
+        sha = hashlib.sha1()
+        for chunk in iter(lambda: fp.read(64 * 1024), ''):
+            sha.update(chunk)
+        return sha.hexdigest()
+
+    def save_fetch_state(self):
+        for key, validators in self._pending_validators.items():
+            if validators:
+                self.http.validators.set(key, validators)
+            else:
+                self.http.validators.delete(key)
+        self._fingerprints.update(self._pending_fingerprints)
+        self._pending_validators = {}
+        self._pending_fingerprints = {}
+        self._stored_input_versions = dict(self.input_versions)
+
+    def input(self, filepath, url):
+        "Data from the scraper that writes filepath, or else downloaded from url"
+        if filepath in self.inputs:
+            return self.inputs[filepath]
+        return self.http.get(url, shared=True).json()
+
+    def inputs_changed(self):
+        # Inputs that weren't handed over get downloaded, so can't be trusted
+        # to be unchanged
+        if any(filepath not in self.inputs for filepath in self.depends_on):
+            return True
+        return self.input_versions != self._stored_input_versions
+
+    def load_output(self):
+        "Makes sure output is set when a run didn't need to fetch the data"
+        if not self.keep_output or self.output is not None:
+            return
+        if not self.last_sha:
+            self.load_last_sha()
+        if self.last_sha:
+            self.output = self.previous_data()
+            self.output_sha = self.last_sha
+
+    def scrape(self):
+        """
+        Fetches the data and works out what, if anything, needs writing.
+
+        Returns a PendingWrite if the data changed, otherwise the value that
+        scrape_and_store() should return.
+        """
+        self._pending_validators = {}
+        self._pending_fingerprints = {}
+        if self.depends_on and not self.inputs_changed():
+            print '%s: Nothing changed (inputs unchanged)' % self.filepath
+            self.load_output()
+            return False
+        try:
+            data = self.fetch_data()
+        except NotModified:
+            print '%s: Nothing changed (not modified)' % self.filepath
+            self.save_fetch_state()
+            self.load_output()
+            return False
         if data is None:
             print '%s; Data was None' % self.filepath
             return
+        data = self.compact(data)
+        content = SerializedContent(data)
+        content_sha = content.git_sha()
+        if self.keep_output:
+            self.output, self.output_sha = data, content_sha
 
         if self.test_mode and not self.github_token:
-            print json.dumps(data, indent=2)
-            return
-
-        # We need to store the data
-        github = GithubContent(self.owner, self.repo, self.github_token)
-        if not self.last_data or not self.last_sha:
-            # Check and see if it exists yet
-            try:
-                content, sha = github.read(self.filepath)
-                self.last_data = json.loads(content)
-                self.last_sha = sha
-            except GithubContent.NotFound:
-                pass
+            content.close()
+            print json.dumps(data, indent=2, default=json_default)
+            return True
 
-        if self.last_data == data:
+        # Compare the blob sha of what we would write with the committed one,
+        # so an unchanged dataset needs neither a deep compare nor a read
+        if not self.last_sha:
+            self.load_last_sha()
+        if content_sha == self.last_sha:
             print '%s: Nothing changed' % self.filepath
-            return
+            content.close()
+            self.save_fetch_state()
+            return False
 
         if self.last_sha:
+            last_data = self.previous_data()
+            # The committed file may have been serialized differently
+            if last_data == data:
+                print '%s: Nothing changed' % self.filepath
+                content.close()
+                self.save_fetch_state()
+                return False
             print 'Updating %s' % self.filepath
-            message = self.update_message(self.last_data, data)
+            message = self.update_message(last_data, data)
         else:
             print 'Creating %s' % self.filepath
             message = self.create_message(data)
 
         if self.test_mode:
+            content.close()
             print message
             print
-            print json.dumps(data, indent=2)
-            return
+            print json.dumps(data, indent=2, default=json_default)
+            return True
 
-        content_sha, commit_sha = github.write(
-            filepath=self.filepath,
-            content=json.dumps(data, indent=2),
-            sha=self.last_sha,
-            commit_message=message,
-            committer=self.committer,
+        return PendingWrite(
+            scraper=self,
+            data=data,
+            content=content,
+            message=message,
         )
 
+    def compact(self, data):
+        if self.compact_records and isinstance(data, list):
+            return RecordSet(data)
+        return data
+
+    def load_last_sha(self):
+        "Sets last_sha to the blob sha of the file in the repository, if any"
+        try:
+            self.last_sha = self.storage.blob_sha(self.filepath)
+        except self.storage.NotFound:
+            self.last_sha = None
+
+    def previous_data(self):
+        """
+        The data as of last_sha - from the state store if it still has that
+        version, otherwise read back from the repository.
+        """
+        saved = self.state.load(self.owner, self.repo, self.filepath)
+        if saved is not None and saved[0] == self.last_sha:
+            return self.compact(saved[1])
+        try:
+            content, sha = self.storage.read(self.filepath)
+        except self.storage.NotFound:
+            return None
+        data = self.compact(json.loads(content))
+        self.last_sha = sha
+        self.state.save(self.owner, self.repo, self.filepath, sha, data)
+        return data
+
+    def stored(self, pending, content_sha, commit_sha):
+        "Called once a PendingWrite from scrape() has been committed"
         self.last_sha = content_sha
-        self.last_data = data
+        self.state.save(
+            self.owner, self.repo, self.filepath, content_sha, pending.data
+        )
+        pending.content.close()
+        self.save_fetch_state()
+
+        self.post_to_slack(pending.message, commit_sha)
+        print self.commit_url(commit_sha) or '%s: committed %s locally' % (
+            self.filepath, commit_sha
+        )
 
-        self.post_to_slack(message, commit_sha)
-        print 'https://github.com/%s/%s/commit/%s' % (
+    def commit_url(self, commit_sha):
+        """
+        The commit on GitHub, or None if it isn't there yet - storage such
+        as LocalGitRepository may not have pushed it
+        """
+        if getattr(self.storage, 'unpushed', False):
+            return None
+        return 'https://github.com/%s/%s/commit/%s' % (
             self.owner, self.repo, commit_sha
         )
+
+    def scrape_and_store(self):
+        "Returns True if the data changed, False if not, None if no data"
+        pending = self.scrape()
+        if not isinstance(pending, PendingWrite):
+            return pending
+
+        try:
+            content_sha, commit_sha = self.storage.write(
+                filepath=self.filepath,
+                content=pending.content,
+                sha=self.last_sha,
+                commit_message=pending.message,
+                committer=self.committer,
+            )
+            self.stored(pending, content_sha, commit_sha)
+        finally:
+            # Already closed by stored() unless the write failed
+            pending.content.close()
+        return True
+
+
+class PendingWrite(object):
+    "Changed data from Scraper.scrape(), waiting to be committed"
+    def __init__(self, scraper, data, content, message):
+        self.scraper = scraper
+        self.data = data
+        self.content = content
+        self.message = message
+
+    @property
+    def filepath(self):
+        return self.scraper.filepath
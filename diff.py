@@ -0,0 +1,65 @@
+"""
+Diffs between an old and a new list of records, matched up by a key.
+
+Everything is indexed in a dict up front, so a diff is a single linear pass
+over each list rather than a scan of one list per record in the other.
+"""
+
+_missing = object()
+
+
+class RecordDiff(object):
+    def __init__(self, added, removed, changed):
+        # Lists of records, in the order they appear in the new / old data
+        self.added = added
+        self.removed = removed
+        # List of (old_record, new_record, changed_fields) tuples
+        self.changed = changed
+
+    def __nonzero__(self):
+        return bool(self.added or self.removed or self.changed)
+
+
+def changed_fields(old_record, new_record):
+    "Sorted list of keys whose values differ between two dicts"
+    fields = []
+    for key in set(old_record.keys()) | set(new_record.keys()):
+        if old_record.get(key, _missing) != new_record.get(key, _missing):
+            fields.append(key)
+    fields.sort()
+    return fields
+
+
+def diff_records(old_records, new_records, key, old_key=None):
+    """
+    key is a function that returns the identifying value of a record. Pass
+    old_key as well if the old records need a different function, for
+    example because the two datasets use different schemas.
+
+    If a key appears more than once, the first record with that key is the
+    one used for comparison.
+    """
+    old_key = old_key or key
+    old_by_key = {}
+    for record in old_records:
+        old_by_key.setdefault(old_key(record), record)
+
+    new_keys = set()
+    added = []
+    changed = []
+    for record in new_records:
+        record_key = key(record)
+        new_keys.add(record_key)
+        old_record = old_by_key.get(record_key, _missing)
+        if old_record is _missing:
+            added.append(record)
+        elif old_record != record:
+            changed.append(
+                (old_record, record, changed_fields(old_record, record))
+            )
+
+    removed = [
+        record for record in old_records
+        if old_key(record) not in new_keys
+    ]
+    return RecordDiff(added, removed, changed)
@@ -1,66 +1,149 @@
+from arcgis import (
+    ArcGisError,
+    LayerQuery,
+    edit_date_field,
+    object_id_field,
+    timestamp,
+)
 from base_scraper import BaseScraper
+from diff import diff_records
+from operator import itemgetter
 import requests
+import time
 
 
-def objectid(d):
-    # Different datasets represent objectid in different ways
-    return d.get('OBJECTID') or d['ObjectID']
+class GisSchema(object):
+    """
+    Different datasets name the same fields in different ways - OBJECTID vs
+    ObjectID, SHELTER_NAME vs label and so on. This works out which variant
+    a dataset uses once, from its first row, so the rows themselves can be
+    read without probing for each alternative every time.
+    """
+    # Attributes worth calling out when a shelter is updated
+    tracked_fields = (
+        ('status', ('SHELTER_STATUS', 'STATUS', 'status')),
+        ('capacity', ('EVACUATION_CAPACITY', 'CAPACITY', 'capacity')),
+        ('population', ('TOTAL_POPULATION', 'POPULATION', 'population')),
+    )
 
+    def __init__(self, rows):
+        first = rows[0] if rows else {}
+        self.objectid_field = 'OBJECTID' if 'OBJECTID' in first else 'ObjectID'
+        self.name_field = 'SHELTER_NAME' if 'SHELTER_NAME' in first else 'label'
+        if 'COUNTY_PARISH' in first:
+            self.county_field = 'COUNTY_PARISH'
+        elif 'county' in first:
+            self.county_field = 'county'
+        else:
+            self.county_field = None
+        self.has_city_state = 'CITY' in first and 'STATE' in first
+        self.fields = {}
+        for label, candidates in self.tracked_fields:
+            for candidate in candidates:
+                if candidate in first:
+                    self.fields[label] = candidate
+                    break
+        self.objectid = itemgetter(self.objectid_field)
+
+    def name(self, row):
+        if self.county_field:
+            s = '%s (%s County)' % (
+                row[self.name_field], row[self.county_field].title()
+            )
+        elif self.has_city_state:
+            s = '%s (%s, %s)' % (
+                row[self.name_field], row['CITY'].title(), row['STATE']
+            )
+        else:
+            s = row[self.name_field]
+        return s.replace('County County', 'County')
 
-def shelter_name(d):
-    return d.get('SHELTER_NAME') or d['label']
+    def value(self, row, label):
+        field = self.fields.get(label)
+        if field is None:
+            return None
+        return row.get(field)
 
 
-def shelter_county(d):
-    return d.get('COUNTY_PARISH') or d['county']
+def describe_changes(old_schema, old_row, new_schema, new_row):
+    "e.g. 'status: OPEN -> CLOSED, population: 10 -> 25'"
+    changes = []
+    for label, candidates in GisSchema.tracked_fields:
+        if label not in old_schema.fields or label not in new_schema.fields:
+            continue
+        old_value = old_schema.value(old_row, label)
+        new_value = new_schema.value(new_row, label)
+        if old_value != new_value:
+            changes.append('%s: %s -> %s' % (label, old_value, new_value))
+    return ', '.join(changes)
 
 
 class BaseGisScraper(BaseScraper):
     source_url = None
+    # For layers with more features than the server returns at once: how
+    # many to ask for per request, and how many requests to make at a time
+    page_size = 1000
+    max_workers = 4
+    # Attributes to fetch, or None for all of them. The object id and edit
+    # date fields are always included
+    out_fields = None
+    # Layers with editor tracking are fetched incrementally - only features
+    # edited since the newest edit we have. Deleted features, and ones that
+    # stop matching the query, are caught by checking the full list of
+    # object ids this often, in seconds
+    reconcile_interval = 15 * 60
+    # Seconds before asking again for layer metadata that couldn't be had
+    layer_info_retry_interval = 60 * 60
+
+    def __init__(self, *args, **kwargs):
+        super(BaseGisScraper, self).__init__(*args, **kwargs)
+        self._layer_info = None
+        self._layer_info_failed_at = None
+        self.reconciled_at = None
+        self._pending_reconciled_at = None
 
     def create_message(self, new_data):
         return self.update_message([], new_data, verb='Created')
 
     def update_message(self, old_data, new_data, verb='Updated'):
-        new_objects = [o for o in new_data if not any(o2 for o2 in old_data if objectid(o2) == objectid(o))]
-        removed_objects = [o for o in old_data if not any(o2 for o2 in new_data if objectid(o2) == objectid(o))]
+        # Old data may predate a schema change upstream, so resolve each
+        # dataset's schema separately
+        old_schema = GisSchema(old_data)
+        new_schema = GisSchema(new_data)
+        diff = diff_records(
+            old_data, new_data,
+            key=new_schema.objectid,
+            old_key=old_schema.objectid,
+        )
         message = []
-
-        def name(row):
-            if 'COUNTY_PARISH' in row or 'county' in row:
-                s = '%s (%s County)' % (shelter_name(row), shelter_county(row).title())
-            elif 'CITY' in row and 'STATE' in row:
-                s = '%s (%s, %s)' % (shelter_name(row), row['CITY'].title(), row['STATE'])
-            else:
-                s = shelter_name(row)
-            return s.replace('County County', 'County')
-
-        for new_object in new_objects:
-            message.append('Added shelter: %s' % name(new_object))
-        if new_objects:
+        for new_object in diff.added:
+            message.append('Added shelter: %s' % new_schema.name(new_object))
+        if diff.added:
             message.append('')
-        for removed_object in removed_objects:
-            message.append('Removed shelter: %s' % name(removed_object))
-        if removed_objects:
+        for removed_object in diff.removed:
+            message.append('Removed shelter: %s' % old_schema.name(removed_object))
+        if diff.removed:
             message.append('')
-        num_updated = 0
-        for new_object in new_data:
-            old_object = [o for o in old_data if objectid(o) == objectid(new_object)]
-            if not old_object:
-                continue
-            old_object = old_object[0]
-            if new_object != old_object:
-                message.append('Updated shelter: %s' % name(new_object))
-                num_updated += 1
+        for old_object, new_object, fields in diff.changed:
+            changes = describe_changes(
+                old_schema, old_object, new_schema, new_object
+            )
+            if changes:
+                message.append('Updated shelter: %s (%s)' % (
+                    new_schema.name(new_object), changes
+                ))
+            else:
+                message.append('Updated shelter: %s' % new_schema.name(new_object))
+        num_updated = len(diff.changed)
         body = '\n'.join(message)
         summary = []
-        if new_objects:
+        if diff.added:
             summary.append('%d shelter%s added' % (
-                len(new_objects), '' if len(new_objects) == 1 else 's',
+                len(diff.added), '' if len(diff.added) == 1 else 's',
             ))
-        if removed_objects:
+        if diff.removed:
             summary.append('%d shelter%s removed' % (
-                len(removed_objects), '' if len(removed_objects) == 1 else 's',
+                len(diff.removed), '' if len(diff.removed) == 1 else 's',
             ))
         if num_updated:
             summary.append('%d shelter%s updated' % (
@@ -74,30 +157,127 @@ class BaseGisScraper(BaseScraper):
             body += '\nChange detected on %s' % self.source_url
         return summary_text + '\n\n' + body
 
+    def layer_info(self, query):
+        """
+        The layer's metadata, or {} if it isn't available - the query works
+        without it, just never incrementally
+        """
+        if self._layer_info is not None:
+            return self._layer_info
+        if self._layer_info_failed_at is not None and (
+            time.time() - self._layer_info_failed_at <
+            self.layer_info_retry_interval
+        ):
+            return {}
+        try:
+            self._layer_info = query.layer_info()
+        except (ArcGisError, requests.RequestException, ValueError), e:
+            print '%s: No layer info (%s)' % (self.filepath, e)
+            self._layer_info_failed_at = time.time()
+            return {}
+        return self._layer_info
+
+    def save_fetch_state(self):
+        super(BaseGisScraper, self).save_fetch_state()
+        if self._pending_reconciled_at is not None:
+            self.reconciled_at = self._pending_reconciled_at
+            self._pending_reconciled_at = None
+
     def fetch_data(self):
-        data = requests.get(self.url).json()
-        shelters = [feature['attributes'] for feature in data['features']]
-        shelters.sort(key=lambda s: objectid(s))
+        query = LayerQuery(
+            self.url,
+            self.http,
+            page_size=self.page_size,
+            max_workers=self.max_workers,
+        )
+        # We never keep the geometry
+        query.update(returnGeometry='false', outSR=None)
+        info = self.layer_info(query)
+        objectid_field = object_id_field(info)
+        edit_field = edit_date_field(info)
+        if self.out_fields:
+            fields = list(self.out_fields)
+            for field in (objectid_field, edit_field):
+                if field and field not in fields:
+                    fields.append(field)
+            query.update(outFields=','.join(fields))
+        self._pending_reconciled_at = None
+        if objectid_field and edit_field:
+            shelters = self.fetch_edits(query, objectid_field, edit_field)
+            if shelters is not None:
+                return shelters
+
+        started = time.time()
+        url = query.url()
+        first = self.fetch(url).json()
+        if first.get('exceededTransferLimit'):
+            # A 304 for the first page says nothing about the others
+            self.discard_validators(url)
+        shelters = [
+            feature['attributes'] for feature in query.features(first)
+        ]
+        shelters.sort(key=GisSchema(shelters).objectid)
+        self._pending_reconciled_at = started
         return shelters
 
+    def fetch_edits(self, query, objectid_field, edit_field):
+        """
+        Merges the features edited since our last data into it, or returns
+        None if there is no data to start from.
+        """
+        if self.test_mode and not self.github_token:
+            return None
+        if not self.last_sha:
+            self.load_last_sha()
+        previous = self.previous_data() if self.last_sha else None
+        edited = [
+            row.get(edit_field) for row in previous or ()
+            if row.get(edit_field) is not None
+        ]
+        if not edited or any(objectid_field not in row for row in previous):
+            return None
+        started = time.time()
+        by_id = dict((row[objectid_field], row) for row in previous)
+        for feature in query.features(where='%s >= %s' % (
+            edit_field, timestamp(max(edited))
+        )):
+            attributes = feature['attributes']
+            by_id[attributes[objectid_field]] = attributes
+        if self.reconciled_at is None or (
+            started - self.reconciled_at > self.reconcile_interval
+        ):
+            field, object_ids = query.object_ids()
+            object_ids = set(object_ids)
+            for object_id in by_id.keys():
+                if object_id not in object_ids:
+                    del by_id[object_id]
+            for feature in query.features_by_id(field, [
+                object_id for object_id in object_ids if object_id not in by_id
+            ]):
+                attributes = feature['attributes']
+                by_id[attributes[objectid_field]] = attributes
+            self._pending_reconciled_at = started
+        return [row for object_id, row in sorted(by_id.items())]
+
 
 class FemaOpenShelters(BaseGisScraper):
     filepath = 'fema-open-shelters.json'
-    url = 'https://gis.fema.gov/REST/services/NSS/OpenShelters/MapServer/0/query?f=json&returnGeometry=true&spatialRel=esriSpatialRelIntersects&geometry=%7B%22xmin%22%3A-10018754.171396945%2C%22ymin%22%3A2504688.5428529754%2C%22xmax%22%3A-7514065.628548954%2C%22ymax%22%3A5009377.085700965%2C%22spatialReference%22%3A%7B%22wkid%22%3A102100%7D%7D&geometryType=esriGeometryEnvelope&inSR=102100&outFields=*&outSR=102100'
+    url = 'https://gis.fema.gov/REST/services/NSS/OpenShelters/MapServer/0/query?f=json&returnGeometry=false&spatialRel=esriSpatialRelIntersects&geometry=%7B%22xmin%22%3A-10018754.171396945%2C%22ymin%22%3A2504688.5428529754%2C%22xmax%22%3A-7514065.628548954%2C%22ymax%22%3A5009377.085700965%2C%22spatialReference%22%3A%7B%22wkid%22%3A102100%7D%7D&geometryType=esriGeometryEnvelope&inSR=102100&outFields=*'
 
 
 class FemaNSS(BaseGisScraper):
     filepath = 'fema-nss-usa.json'
-    url = 'https://gis.fema.gov/REST/services/NSS/FEMA_NSS/MapServer/0/query?f=json&returnGeometry=true&spatialRel=esriSpatialRelIntersects&geometry=%7B%22xmin%22%3A+-14404742.108649602%2C+%22ymin%22%3A+-55660.4518654215%2C+%22ymax%22%3A+6782064.328749425%2C+%22xmax%22%3A+-5988988.6046781195%2C+%22spatialReference%22%3A+%7B%22wkid%22%3A+102100%7D%7D&geometryType=esriGeometryEnvelope&inSR=102100&outFields=*&outSR=102100'
+    compact_records = True
+    url = 'https://gis.fema.gov/REST/services/NSS/FEMA_NSS/MapServer/0/query?f=json&returnGeometry=false&spatialRel=esriSpatialRelIntersects&geometry=%7B%22xmin%22%3A+-14404742.108649602%2C+%22ymin%22%3A+-55660.4518654215%2C+%22ymax%22%3A+6782064.328749425%2C+%22xmax%22%3A+-5988988.6046781195%2C+%22spatialReference%22%3A+%7B%22wkid%22%3A+102100%7D%7D&geometryType=esriGeometryEnvelope&inSR=102100&outFields=*'
 
 
 class GemaAnimalShelters(BaseGisScraper):
     filepath = 'georgia-gema-animal-shelters.json'
-    url = 'https://services1.arcgis.com/2iUE8l8JKrP2tygQ/arcgis/rest/services/AnimalShelters/FeatureServer/0/query?f=json&where=status%20%3D%20%27OPEN%27&returnGeometry=true&spatialRel=esriSpatialRelIntersects&outFields=*&outSR=102100&resultOffset=0&resultRecordCount=1000'
+    url = 'https://services1.arcgis.com/2iUE8l8JKrP2tygQ/arcgis/rest/services/AnimalShelters/FeatureServer/0/query?f=json&where=status%20%3D%20%27OPEN%27&returnGeometry=false&spatialRel=esriSpatialRelIntersects&outFields=*'
     source_url = 'https://gema-soc.maps.arcgis.com/apps/webappviewer/index.html?id=279ef7cfc1da45edb640723c12b02b18'
 
 
 class GemaActiveShelters(BaseGisScraper):
     filepath = 'georgia-gema-active-shelters.json'
-    url = 'https://services1.arcgis.com/2iUE8l8JKrP2tygQ/arcgis/rest/services/SheltersActive/FeatureServer/0/query?f=json&where=shelter_information_shelter_type%20%3C%3E%20%27Reception%20Care%20Ctr.%27&returnGeometry=true&spatialRel=esriSpatialRelIntersects&outFields=*&outSR=102100&resultOffset=0&resultRecordCount=1000'
+    url = 'https://services1.arcgis.com/2iUE8l8JKrP2tygQ/arcgis/rest/services/SheltersActive/FeatureServer/0/query?f=json&where=shelter_information_shelter_type%20%3C%3E%20%27Reception%20Care%20Ctr.%27&returnGeometry=false&spatialRel=esriSpatialRelIntersects&outFields=*'
     source_url = 'https://gema-soc.maps.arcgis.com/apps/webappviewer/index.html?id=279ef7cfc1da45edb640723c12b02b18'
@@ -4,10 +4,23 @@ GitHub Contents API can't handle files larger than 1MB - this class knows how
 to spot that proble and switch to the large-file-supporting low level Git Data
 API instead.
 
+Large reads don't walk the recursive tree listing: the branch head is looked
+up with a conditional request, directory trees are cached by their (immutable)
+sha, and blobs are downloaded raw rather than as base64 JSON.
+
+Content can be passed as a string or a serialization.SerializedContent; either
+way it is base64-encoded and uploaded in chunks, never as one big payload.
+
+It can also commit several files at once - write_many() uploads the blobs in
+parallel, then builds a single tree and commit and moves the branch once.
+
 https://developer.github.com/v3/repos/contents/
 https://developer.github.com/v3/git/
 """
-import requests
+from http_client import default_client
+from multiprocessing.pool import ThreadPool
+from serialization import SerializedContent, StreamingJSONBody
+import threading
 
 
 class GithubContent(object):
@@ -17,10 +30,22 @@ class GithubContent(object):
     class UnknownError(Exception):
         pass
 
-    def __init__(self, owner, repo, token):
+    class Conflict(Exception):
+        "A file changed in the repository since the sha we were given"
+        pass
+
+    # Shared by every instance: tree listings keyed by tree sha, which can
+    # never change, and the last seen head of each (owner, repo, branch)
+    _trees = {}
+    _heads = {}
+    _cache_lock = threading.Lock()
+    max_cached_trees = 256
+
+    def __init__(self, owner, repo, token, http=None):
         self.owner = owner
         self.repo = repo
         self.token = token
+        self.http = http or default_client()
 
     def base_url(self):
         return 'https://api.github.com/repos/%s/%s' % (
@@ -30,7 +55,7 @@ class GithubContent(object):
     def read(self, filepath):
         # Try reading using content API
         content_url = self.base_url() + '/contents/%s' % filepath
-        response = requests.get(
+        response = self.http.get(
             content_url,
             headers={
                 'Authorization': 'token %s' % self.token
@@ -50,30 +75,97 @@ class GithubContent(object):
         else:
             raise self.UnknownError(response.content)
 
-    def read_large(self, filepath):
-        master = requests.get(
-            self.base_url() + '/git/trees/master?recursive=1',
-            headers={
-                'Authorization': 'token %s' % self.token
-            }
+    def auth_headers(self, **extra):
+        headers = {'Authorization': 'token %s' % self.token}
+        headers.update(extra)
+        return headers
+
+    def head(self, branch='master'):
+        """
+        Returns (commit_sha, tree_sha) for the tip of branch. Uses a conditional
+        request, so if the branch hasn't moved this is a 304 - which GitHub
+        doesn't count against the rate limit.
+        """
+        key = (self.owner, self.repo, branch)
+        cached = self._heads.get(key)
+        headers = self.auth_headers()
+        if cached:
+            headers['If-None-Match'] = cached['etag']
+        response = self.http.get(
+            self.base_url() + '/git/refs/heads/%s' % branch,
+            headers=headers,
+        )
+        if response.status_code == 304 and cached:
+            return cached['commit'], cached['tree']
+        elif response.status_code != 200:
+            raise self.UnknownError(str(response.status_code) + ':' + response.content)
+        commit_sha = response.json()['object']['sha']
+        if cached and cached['commit'] == commit_sha:
+            tree_sha = cached['tree']
+        else:
+            tree_sha = self.http.get(
+                self.base_url() + '/git/commits/%s' % commit_sha,
+                headers=self.auth_headers(),
+            ).json()['tree']['sha']
+        self._heads[key] = {
+            'etag': response.headers.get('ETag'),
+            'commit': commit_sha,
+            'tree': tree_sha,
+        }
+        return commit_sha, tree_sha
+
+    def tree(self, tree_sha):
+        "Returns {name: entry} for a single (non-recursive) tree"
+        tree = self._trees.get(tree_sha)
+        if tree is not None:
+            return tree
+        data = self.http.get(
+            self.base_url() + '/git/trees/%s' % tree_sha,
+            headers=self.auth_headers(),
         ).json()
-        try:
-            tree_entry = [t for t in master['tree'] if t['path'] == filepath][0]
-        except IndexError:
+        tree = dict((entry['path'], entry) for entry in data['tree'])
+        with self._cache_lock:
+            if len(self._trees) >= self.max_cached_trees:
+                self._trees.clear()
+            self._trees[tree_sha] = tree
+        return tree
+
+    def blob_sha(self, filepath, branch='master'):
+        "Looks up the blob sha of filepath, one directory level at a time"
+        commit_sha, tree_sha = self.head(branch)
+        return self.tree_blob_sha(tree_sha, filepath)
+
+    def tree_blob_sha(self, tree_sha, filepath):
+        parts = filepath.strip('/').split('/')
+        for directory in parts[:-1]:
+            entry = self.tree(tree_sha).get(directory)
+            if entry is None or entry['type'] != 'tree':
+                raise self.NotFound(filepath)
+            tree_sha = entry['sha']
+        entry = self.tree(tree_sha).get(parts[-1])
+        if entry is None or entry['type'] != 'blob':
             raise self.NotFound(filepath)
-        data = requests.get(
-            tree_entry['url'],
-            headers={
-                'Authorization': 'token %s' % self.token
-            }
-        ).json()
-        return data['content'].decode('base64'), data['sha']
+        return entry['sha']
+
+    def read_blob(self, sha):
+        "Downloads a blob as raw bytes, skipping the base64 JSON wrapper"
+        response = self.http.get(
+            self.base_url() + '/git/blobs/%s' % sha,
+            headers=self.auth_headers(Accept='application/vnd.github.v3.raw'),
+        )
+        if response.status_code != 200:
+            raise self.UnknownError(str(response.status_code) + ':' + response.content)
+        return response.content
+
+    def read_large(self, filepath):
+        sha = self.blob_sha(filepath)
+        return self.read_blob(sha), sha
 
     def write(self, filepath, content, sha=None, commit_message=None, committer=None):
         github_url = self.base_url() + '/contents/%s' % filepath
+        content = SerializedContent.from_string(content)
         payload = {
             'path': filepath,
-            'content': content.encode('base64'),
             'message': commit_message,
         }
         if sha:
@@ -81,12 +173,11 @@ class GithubContent(object):
         if committer:
             payload['committer'] = committer
 
-        response = requests.put(
+        # The base64 content is streamed into the request body
+        response = self.http.put(
             github_url,
-            json=payload,
-            headers={
-                'Authorization': 'token %s' % self.token
-            }
+            data=StreamingJSONBody(payload, 'content', content),
+            headers=self.auth_headers(**{'Content-Type': 'application/json'}),
         )
         if response.status_code == 403 and response.json()['errors'][0]['code'] == 'too_large':
             return self.write_large(filepath, content, commit_message, committer)
@@ -108,22 +199,14 @@ class GithubContent(object):
 
     def write_large(self, filepath, content, commit_message=None, committer=None):
         # Create a new blob with the file contents
-        created_blob = requests.post(self.base_url() + '/git/blobs', json={
-            'encoding': 'utf8',
-            'content': content,
-        }, headers={'Authorization': 'token %s' % self.token}).json()
-        # Retrieve master tree sha
-        master_sha = requests.get(
-            self.base_url() + '/git/trees/master?recursive=1',
-            headers={
-                'Authorization': 'token %s' % self.token
-            }
-        ).json()['sha']
+        created_blob = {'sha': self.create_blob(content)}
+        # Retrieve the current master commit and its tree
+        head_sha, base_tree = self.head('master')
         # Construct a new tree
-        created_tree = requests.post(
+        created_tree = self.http.post(
             self.base_url() + '/git/trees',
             json={
-                'base_tree': master_sha,
+                'base_tree': base_tree,
                 'tree': [{
                     'mode': '100644', # file (blob),
                     'path': filepath,
@@ -136,20 +219,109 @@ class GithubContent(object):
         # Create a commit which references the new tree
         payload = {
             'message': commit_message,
-            'parents': [master_sha],
+            'parents': [head_sha],
             'tree': created_tree['sha'],
         }
         if committer:
             payload['committer'] = committer
-        created_commit = requests.post(
+        created_commit = self.http.post(
             self.base_url() + '/git/commits',
             json=payload,
             headers={'Authorization': 'token %s' % self.token}
         ).json()
         # Move HEAD reference on master to the new commit
-        requests.patch(
+        self.http.patch(
             self.base_url() + '/git/refs/heads/master',
             json={'sha': created_commit['sha']},
             headers={'Authorization': 'token %s' % self.token}
         ).json()
         return created_blob['sha'], created_commit['sha']
+
+    def create_blob(self, content):
+        response = self.http.post(
+            self.base_url() + '/git/blobs',
+            data=StreamingJSONBody({'encoding': 'base64'}, 'content', content),
+            headers=self.auth_headers(**{'Content-Type': 'application/json'}),
+        )
+        if response.status_code != 201:
+            raise self.UnknownError(str(response.status_code) + ':' + response.content)
+        return response.json()['sha']
+
+    def write_many(self, files, commit_message=None, committer=None, branch='master', max_parallel=8, attempts=3):
+        """
+        Commits several files in one go. files is a list of (filepath, content)
+        pairs, or (filepath, content, sha) where sha is the blob sha the file
+        should have before the commit - like write()'s sha, Conflict is
+        raised if it doesn't. Returns (commit_sha, {filepath: blob_sha}).
+
+        The branch is moved with a non-forced ref update, so if it moved
+        under us the commit is rebuilt on the new head, checking the shas
+        again.
+        """
+        headers = {'Authorization': 'token %s' % self.token}
+        pool = ThreadPool(max(1, min(max_parallel, len(files))))
+        try:
+            blob_shas = pool.map(
+                self.create_blob, [file[1] for file in files]
+            )
+        finally:
+            pool.close()
+        shas = dict(zip([file[0] for file in files], blob_shas))
+        expected_shas = dict(
+            (file[0], file[2]) for file in files
+            if len(file) > 2 and file[2] is not None
+        )
+        ref_url = self.base_url() + '/git/refs/heads/%s' % branch
+        for attempt in range(attempts):
+            head_sha, base_tree = self.head(branch)
+            for filepath, expected_sha in sorted(expected_shas.items()):
+                try:
+                    current_sha = self.tree_blob_sha(base_tree, filepath)
+                except self.NotFound:
+                    current_sha = None
+                if current_sha != expected_sha:
+                    raise self.Conflict('%s is at %s, not %s' % (
+                        filepath, current_sha, expected_sha
+                    ))
+            response = self.http.post(
+                self.base_url() + '/git/trees',
+                json={
+                    'base_tree': base_tree,
+                    'tree': [{
+                        'mode': '100644', # file (blob),
+                        'path': filepath,
+                        'type': 'blob',
+                        'sha': sha,
+                    } for filepath, sha in sorted(shas.items())]
+                },
+                headers=headers,
+            )
+            if response.status_code != 201:
+                raise self.UnknownError(str(response.status_code) + ':' + response.content)
+            created_tree = response.json()
+            payload = {
+                'message': commit_message,
+                'parents': [head_sha],
+                'tree': created_tree['sha'],
+            }
+            if committer:
+                payload['committer'] = committer
+            response = self.http.post(
+                self.base_url() + '/git/commits',
+                json=payload,
+                headers=headers,
+            )
+            if response.status_code != 201:
+                raise self.UnknownError(str(response.status_code) + ':' + response.content)
+            created_commit = response.json()
+            response = self.http.patch(
+                ref_url,
+                json={'sha': created_commit['sha']},
+                headers=headers,
+            )
+            if response.status_code == 200:
+                return created_commit['sha'], shas
+            elif response.status_code != 422:
+                break
+            # 422 means the branch moved under us - rebuild on the new head
+        raise self.UnknownError(str(response.status_code) + ':' + response.content)
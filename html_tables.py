@@ -0,0 +1,254 @@
+"""
+Single-pass extraction of tables from HTML pages.
+
+Rather than building a whole BeautifulSoup tree and then searching it, this
+runs HTMLParser over the page once and collects just the rows of the tables
+we ask for, as lists of Cells. Cell text matches what BeautifulSoup 3's
+getText() gives: each run of text stripped and joined together, with entity
+references left as they are.
+
+A table is picked out by a selector dict, with any of these keys:
+
+    index   - which of the matching tables to take, 0 being the first
+    attrs   - attribute values the <table> must have, e.g. {'id': 'x'}
+    within  - attribute values of an element the table must be inside
+
+Tables are counted in document order, including nested ones. The rows of a
+nested table belong to that table only, though its text still counts
+towards the text of the enclosing cell.
+"""
+from HTMLParser import HTMLParser, HTMLParseError
+import re
+
+meta_charset_re = re.compile(r'<meta[^>]+charset=["\']?([-\w]+)', re.I)
+table_tags = ('table', 'thead', 'tbody', 'tfoot', 'tr', 'td', 'th')
+# Elements that never have an end tag
+void_tags = (
+    'area', 'base', 'br', 'col', 'embed', 'hr', 'img', 'input', 'link',
+    'meta', 'param', 'source', 'track', 'wbr',
+)
+
+
+class Cell(object):
+    __slots__ = ('tag', 'attrs', 'text', 'elements', '_pieces')
+
+    def __init__(self, tag, attrs):
+        self.tag = tag
+        self.attrs = attrs
+        self.text = u''
+        # (tag, attrs) for each element inside the cell, in document order
+        self.elements = []
+        self._pieces = []
+
+    def get(self, name, default=None):
+        return self.attrs.get(name, default)
+
+    def find(self, tag):
+        "The attributes of the first <tag> in the cell, or None"
+        for element_tag, attrs in self.elements:
+            if element_tag == tag:
+                return attrs
+        return None
+
+    def __repr__(self):
+        return '<%s %r>' % (self.tag, self.text)
+
+
+class Row(object):
+    __slots__ = ('attrs', 'section', 'cells')
+
+    def __init__(self, attrs, section):
+        self.attrs = attrs
+        # 'thead', 'tbody', 'tfoot' or None
+        self.section = section
+        self.cells = []
+
+    @property
+    def tds(self):
+        return [cell for cell in self.cells if cell.tag == 'td']
+
+    @property
+    def ths(self):
+        return [cell for cell in self.cells if cell.tag == 'th']
+
+    @property
+    def text(self):
+        return u''.join(cell.text for cell in self.cells)
+
+
+class _Table(object):
+    def __init__(self, selectors):
+        # Indexes into TableExtractor.selectors this table satisfies
+        self.selectors = selectors
+        self.section = None
+        self.row = None
+        self.cell = None
+        self.rows = []
+
+
+class TableExtractor(HTMLParser):
+    def __init__(self, selectors):
+        HTMLParser.__init__(self)
+        self.selectors = selectors
+        self.results = [None] * len(selectors)
+        self.counts = [0] * len(selectors)
+        self.tables = []
+        # One entry per open element, for matching 'within'
+        self.open_elements = []
+        self.text = []
+
+    def close_element(self, tag):
+        # Tolerate unclosed elements, the way browsers do
+        for i in range(len(self.open_elements) - 1, -1, -1):
+            if self.open_elements[i][0] == tag:
+                del self.open_elements[i:]
+                return
+
+    def matches(self, selector, attrs):
+        for name, value in (selector.get('attrs') or {}).items():
+            if attrs.get(name) != value:
+                return False
+        within = selector.get('within')
+        if within:
+            return any(
+                all(element_attrs.get(k) == v for k, v in within.items())
+                for _, element_attrs in self.open_elements
+            )
+        return True
+
+    def flush_text(self):
+        if not self.text:
+            return
+        text = u''.join(self.text).strip()
+        self.text = []
+        if not text:
+            return
+        for table in self.tables:
+            if table.selectors and table.cell is not None:
+                table.cell._pieces.append(text)
+
+    def close_cell(self, table):
+        if table.cell is not None:
+            table.cell.text = u''.join(table.cell._pieces)
+            table.cell._pieces = None
+            table.cell = None
+
+    def close_row(self, table):
+        self.close_cell(table)
+        if table.row is not None and table.selectors:
+            table.rows.append(table.row)
+        table.row = None
+
+    def handle_starttag(self, tag, attrs):
+        self.flush_text()
+        # Attributes without a value get their name as the value, as
+        # BeautifulSoup 3 does
+        attrs = dict((k, k if v is None else v) for k, v in attrs)
+        if tag == 'table':
+            selectors = []
+            for i, selector in enumerate(self.selectors):
+                if self.results[i] is not None or not self.matches(selector, attrs):
+                    continue
+                if self.counts[i] == selector.get('index', 0):
+                    selectors.append(i)
+                self.counts[i] += 1
+            self.tables.append(_Table(selectors))
+        elif self.tables and self.tables[-1].selectors:
+            table = self.tables[-1]
+            if tag in ('thead', 'tbody', 'tfoot'):
+                self.close_row(table)
+                table.section = tag
+            elif tag == 'tr':
+                self.close_row(table)
+                table.row = Row(attrs, table.section)
+            elif tag in ('td', 'th'):
+                self.close_cell(table)
+                if table.row is None:
+                    table.row = Row({}, table.section)
+                table.cell = Cell(tag, attrs)
+                table.row.cells.append(table.cell)
+        if tag not in table_tags:
+            for table in self.tables:
+                if table.cell is not None:
+                    table.cell.elements.append((tag, attrs))
+        if tag not in void_tags:
+            self.open_elements.append((tag, attrs))
+
+    def handle_startendtag(self, tag, attrs):
+        self.handle_starttag(tag, attrs)
+        if tag not in void_tags:
+            self.close_element(tag)
+
+    def handle_endtag(self, tag):
+        self.flush_text()
+        self.close_element(tag)
+        if not self.tables:
+            return
+        table = self.tables[-1]
+        if tag == 'table':
+            self.close_row(table)
+            self.tables.pop()
+            for i in table.selectors:
+                self.results[i] = table.rows
+        elif tag in ('td', 'th'):
+            self.close_cell(table)
+        elif tag == 'tr':
+            self.close_row(table)
+        elif tag in ('thead', 'tbody', 'tfoot'):
+            self.close_row(table)
+            table.section = None
+
+    def handle_data(self, data):
+        self.text.append(data)
+
+    # Entity and character references are kept as they are, as in
+    # BeautifulSoup 3's default mode
+    def handle_entityref(self, name):
+        self.text.append(u'&%s;' % name)
+
+    def handle_charref(self, name):
+        self.text.append(u'&#%s;' % name)
+
+    def handle_comment(self, data):
+        self.flush_text()
+        self.text.append(data)
+        self.flush_text()
+
+    def finish(self):
+        self.flush_text()
+        # Anything still open at the end of the page is closed implicitly
+        while self.tables:
+            self.handle_endtag('table')
+        return self.results
+
+
+def decode(html):
+    "Decodes using the charset in a <meta> tag, falling back to utf-8"
+    if isinstance(html, unicode):
+        return html
+    match = meta_charset_re.search(html[:4096])
+    encodings = [match.group(1)] if match else []
+    for encoding in encodings + ['utf-8', 'windows-1252']:
+        try:
+            return html.decode(encoding)
+        except (UnicodeDecodeError, LookupError):
+            continue
+    return html.decode('latin-1')
+
+
+def extract_tables(html, *selectors):
+    """
+    Returns one list of Rows per selector, or None for a selector that
+    didn't match any table.
+    """
+    parser = TableExtractor(selectors)
+    try:
+        parser.feed(decode(html))
+        parser.close()
+    except HTMLParseError:
+        pass
+    return parser.finish()
+
+
+def extract_table(html, **selector):
+    return extract_tables(html, selector)[0]
@@ -0,0 +1,337 @@
+"""
+A shared, connection-pooled HTTP client for the scrapers and GithubContent.
+
+Everything goes through a single requests.Session, so connections to a host
+are kept alive and reused between calls (and between scrapers) instead of
+paying for a fresh TCP and TLS handshake on every request. Pool sizes and the
+default timeout live here, in one place.
+
+It can also keep a ValidatorCache - the ETag / Last-Modified validators seen
+for each URL, stored on disk so they survive restarts - which Scraper.fetch()
+uses to make conditional requests.
+
+Requests made with shared=True go through a SingleFlight: identical requests
+made at the same time, or within a few seconds of each other, are sent once
+and share the one response - including its parsed JSON.
+"""
+from requests.adapters import HTTPAdapter
+import requests
+import hashlib
+import json
+import os
+import threading
+import time
+
+
+class NotModified(Exception):
+    "Raised when a conditional request tells us the resource is unchanged"
+    pass
+
+
+class ValidatorCache(object):
+    """
+    Size-bounded store of HTTP validators, keyed by an arbitrary string.
+
+    Each key is written to its own small JSON file in directory; once the
+    files add up to more than max_bytes the least recently written ones are
+    evicted. With directory=None everything is kept in memory instead.
+    """
+    max_bytes = 1024 * 1024
+
+    def __init__(self, directory=None, max_bytes=None):
+        self.directory = directory
+        if max_bytes is not None:
+            self.max_bytes = max_bytes
+        self._memory = {}
+        self._lock = threading.Lock()
+        self._total_bytes = 0
+        if directory is not None:
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+            for filename in os.listdir(directory):
+                self._total_bytes += os.path.getsize(
+                    os.path.join(directory, filename)
+                )
+
+    def path(self, key):
+        return os.path.join(
+            self.directory, hashlib.sha1(key).hexdigest() + '.json'
+        )
+
+    def get(self, key):
+        "Returns a dict of validators, or None if we have none for key"
+        with self._lock:
+            if self.directory is None:
+                return self._memory.get(key)
+            try:
+                with open(self.path(key)) as fp:
+                    entry = json.load(fp)
+            except (IOError, ValueError):
+                return None
+        if entry.get('key') != key:
+            return None
+        return entry['validators']
+
+    def set(self, key, validators):
+        with self._lock:
+            if self.directory is None:
+                self._memory[key] = validators
+                return
+            path = self.path(key)
+            if os.path.exists(path):
+                self._total_bytes -= os.path.getsize(path)
+            content = json.dumps({
+                'key': key,
+                'validators': validators,
+            })
+            # Write then rename, so a crash never leaves a truncated file
+            with open(path + '.tmp', 'w') as fp:
+                fp.write(content)
+            os.rename(path + '.tmp', path)
+            self._total_bytes += len(content)
+            if self._total_bytes > self.max_bytes:
+                self.evict()
+
+    def evict(self):
+        # Drop the oldest entries until we are back under half the limit
+        paths = [
+            os.path.join(self.directory, filename)
+            for filename in os.listdir(self.directory)
+        ]
+        paths.sort(key=os.path.getmtime)
+        for path in paths:
+            if self._total_bytes <= self.max_bytes / 2:
+                break
+            self._total_bytes -= os.path.getsize(path)
+            os.remove(path)
+
+    def delete(self, key):
+        with self._lock:
+            if self.directory is None:
+                self._memory.pop(key, None)
+                return
+            path = self.path(key)
+            if os.path.exists(path):
+                self._total_bytes -= os.path.getsize(path)
+                os.remove(path)
+
+
+def response_validators(response):
+    "The validators from a response that are worth sending back next time"
+    validators = {}
+    if response.headers.get('ETag'):
+        validators['etag'] = response.headers['ETag']
+    if response.headers.get('Last-Modified'):
+        validators['last_modified'] = response.headers['Last-Modified']
+    return validators
+
+
+def conditional_headers(validators):
+    headers = {}
+    if validators.get('etag'):
+        headers['If-None-Match'] = validators['etag']
+    if validators.get('last_modified'):
+        headers['If-Modified-Since'] = validators['last_modified']
+    return headers
+
+
+class SharedResponse(object):
+    """
+    A fully read response handed to every caller of a coalesced request.
+    json() is only parsed once, so callers must not modify what it returns.
+    """
+    def __init__(self, response):
+        # Reads the whole body, which also releases the connection
+        response.content
+        self._response = response
+        self._json = None
+        self._lock = threading.Lock()
+
+    def json(self, **kwargs):
+        if kwargs:
+            return self._response.json(**kwargs)
+        with self._lock:
+            if self._json is None:
+                self._json = (self._response.json(),)
+            return self._json[0]
+
+    def __getattr__(self, name):
+        return getattr(self._response, name)
+
+
+class _Flight(object):
+    def __init__(self):
+        self.done = threading.Event()
+        self.response = None
+        self.error = None
+        self.expires = None
+
+
+class SingleFlight(object):
+    """
+    Coalesces identical requests. While one is in flight anyone else making
+    it waits for its response rather than sending another, and a completed
+    response is reused for ttl seconds. Failures - exceptions and error
+    statuses - are only shared with callers that were already waiting.
+    """
+    ttl = 30
+    # Requests using any other keyword arguments, e.g. stream, are never
+    # coalesced
+    key_arguments = ('params', 'data', 'json', 'headers')
+
+    def __init__(self, ttl=None):
+        if ttl is not None:
+            self.ttl = ttl
+        self._flights = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, method, url, kwargs):
+        "The key identifying a request, or None if it can't be coalesced"
+        if set(kwargs) - set(self.key_arguments) - set(['timeout']):
+            return None
+        try:
+            return json.dumps([method.upper(), url] + [
+                kwargs.get(name) for name in self.key_arguments
+            ], sort_keys=True)
+        except (TypeError, ValueError):
+            return None
+
+    def request(self, key, make_request):
+        now = time.time()
+        with self._lock:
+            for other_key, flight in self._flights.items():
+                if flight.expires is not None and flight.expires <= now:
+                    del self._flights[other_key]
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = _Flight()
+                self.misses += 1
+            else:
+                self.hits += 1
+        if leader:
+            try:
+                flight.response = SharedResponse(make_request())
+            except Exception, e:
+                flight.error = e
+            if flight.error is not None or not reusable(flight.response):
+                # Callers already waiting still get it, later ones retry
+                with self._lock:
+                    if self._flights.get(key) is flight:
+                        del self._flights[key]
+            flight.expires = time.time() + self.ttl
+            flight.done.set()
+        else:
+            flight.done.wait()
+        if flight.error is not None:
+            raise flight.error
+        return flight.response
+
+    def clear(self):
+        "Forgets completed responses, e.g. at the start of each cycle"
+        with self._lock:
+            for key, flight in self._flights.items():
+                if flight.done.is_set():
+                    del self._flights[key]
+
+
+def reusable(response):
+    "Only successful and not modified responses are worth sharing later"
+    return 200 <= response.status_code < 300 or response.status_code == 304
+
+
+class HttpClient(object):
+    # Number of hosts to keep a connection pool for - we scrape around thirty
+    pool_connections = 50
+    # Maximum connections kept open per host
+    pool_maxsize = 10
+    # Default timeout in seconds, for calls that don't specify their own
+    timeout = 60
+    # Seconds a shared=True response is reused for
+    shared_ttl = 30
+
+    def __init__(self, pool_connections=None, pool_maxsize=None, timeout=None, cache_dir=None, cache_max_bytes=None, shared_ttl=None):
+        if pool_connections is not None:
+            self.pool_connections = pool_connections
+        if pool_maxsize is not None:
+            self.pool_maxsize = pool_maxsize
+        if timeout is not None:
+            self.timeout = timeout
+        self.session = requests.Session()
+        self.adapter = HTTPAdapter(
+            pool_connections=self.pool_connections,
+            pool_maxsize=self.pool_maxsize,
+        )
+        self.session.mount('http://', self.adapter)
+        self.session.mount('https://', self.adapter)
+        self.validators = ValidatorCache(cache_dir, cache_max_bytes)
+        self.flights = SingleFlight(
+            self.shared_ttl if shared_ttl is None else shared_ttl
+        )
+        self.requests_made = 0
+        self._lock = threading.Lock()
+
+    def request(self, method, url, shared=False, **kwargs):
+        """
+        With shared=True the request may be coalesced with identical ones
+        from other callers, see SingleFlight - only use it for reads whose
+        result can be a few seconds old.
+        """
+        kwargs.setdefault('timeout', self.timeout)
+        key = self.flights.key(method, url, kwargs) if shared else None
+        if key is not None:
+            return self.flights.request(
+                key, lambda: self.send(method, url, **kwargs)
+            )
+        return self.send(method, url, **kwargs)
+
+    def send(self, method, url, **kwargs):
+        with self._lock:
+            self.requests_made += 1
+        return self.session.request(method, url, **kwargs)
+
+    def get(self, url, **kwargs):
+        return self.request('GET', url, **kwargs)
+
+    def post(self, url, data=None, **kwargs):
+        return self.request('POST', url, data=data, **kwargs)
+
+    def put(self, url, data=None, **kwargs):
+        return self.request('PUT', url, data=data, **kwargs)
+
+    def patch(self, url, data=None, **kwargs):
+        return self.request('PATCH', url, data=data, **kwargs)
+
+    def stats(self):
+        "Counts of requests made, shared and connections opened vs reused"
+        connections_opened = 0
+        pool_requests = 0
+        pools = self.adapter.poolmanager.pools
+        for key in pools.keys():
+            pool = pools.get(key)
+            if pool is None:
+                continue
+            connections_opened += pool.num_connections
+            pool_requests += pool.num_requests
+        return {
+            'requests': self.requests_made,
+            'connections_opened': connections_opened,
+            'connections_reused': max(0, pool_requests - connections_opened),
+            'shared_hits': self.flights.hits,
+            'shared_misses': self.flights.misses,
+        }
+
+
+_default_client = None
+_default_client_lock = threading.Lock()
+
+
+def default_client():
+    "The process-wide HttpClient used when none is passed in explicitly"
+    global _default_client
+    with _default_client_lock:
+        if _default_client is None:
+            _default_client = HttpClient()
+        return _default_client
@@ -20,22 +20,25 @@ from north_bay import (
     CaliforniaHighwayPatrolIncidents,
     PGEOutagesIndividual,
 )
-from BeautifulSoup import BeautifulSoup as Soup
-import requests
+from runner import AdaptiveScheduler, CycleRunner
+from http_client import HttpClient
+from local_git import LocalGitRepository
+from state import StateStore
+from html_tables import extract_table
+from xml_stream import KML, iter_elements
 import os
 import sys
 import time
 import json
-import datetime
+import re
 import zipfile
-import StringIO
-from xml.etree import ElementTree
 
 
 class GoogleCrisisKmlScraper(BaseScraper):
     url = 'https://www.google.com/maps/d/u/1/kml?mid=1fJ4NZ21YW1Ru856hehpufId79CA&ll=22.47126398588183%2C-60.6005859375&z=5&cm.ttl=600'
     source_url = 'http://google.org/crisismap/2017-irma'
     filepath = 'google-crisis-irma-2017.json'
+    fingerprint = True
 
     def create_message(self, new_data):
         return self.update_message([], new_data, verb='Created')
@@ -59,19 +62,31 @@ class GoogleCrisisKmlScraper(BaseScraper):
         message += '\nChange detected on %s' % self.source_url
         return message
 
+    def fingerprint_file(self, fp):
+        # The zip wrapper is regenerated on every request, the KML isn't
+        try:
+            kml = zipfile.ZipFile(fp).open('doc.kml')
+        except zipfile.BadZipfile:
+            fp.seek(0)
+            return super(GoogleCrisisKmlScraper, self).fingerprint_file(fp)
+        return super(GoogleCrisisKmlScraper, self).fingerprint_file(kml)
+
     def fetch_data(self):
-        zipped = requests.get(self.url).content
-        zipdata = zipfile.ZipFile(StringIO.StringIO(zipped))
-        kml = zipdata.open('doc.kml').read()
-        et = ElementTree.fromstring(kml)
-        shelters = []
-        for placemark in et.findall('.//{http://www.opengis.net/kml/2.2}Placemark'):
+        zipped = self.fetch_file(self.url)
+        try:
+            kml = zipfile.ZipFile(zipped).open('doc.kml')
+            return list(self.parse_placemarks(kml))
+        finally:
+            zipped.close()
+
+    def parse_placemarks(self, kml):
+        for placemark, _ in iter_elements(kml, KML + 'Placemark'):
             shelter = {}
-            for data in placemark.findall('{http://www.opengis.net/kml/2.2}ExtendedData/{http://www.opengis.net/kml/2.2}Data'):
+            for data in placemark.findall(KML + 'ExtendedData/' + KML + 'Data'):
                 key = data.attrib['name']
                 value = ''.join(s.strip() for s in data.itertext())
                 shelter[key] = value
-            coords = placemark.find('.//{http://www.opengis.net/kml/2.2}coordinates').text.strip()
+            coords = placemark.find('.//' + KML + 'coordinates').text.strip()
             longitude, latitude, _ = coords.split(',')
             shelter.update({
                 'latitude': latitude,
@@ -80,13 +95,13 @@ class GoogleCrisisKmlScraper(BaseScraper):
             if 'Phone' in shelter:
                 # They come through in scientific number format for some reason
                 shelter['Phone'] = shelter['Phone'].replace('.', '').replace('E9', '')
-            shelters.append(shelter)
-        return shelters
+            yield shelter
 
 
 class SouthCarolinaShelters(BaseScraper):
     url = 'http://scemd.org/ShelterStatus.html'
     filepath = 'scemd-shelters.json'
+    fingerprint = True
 
     def create_message(self, new_data):
         return self.update_message([], new_data, verb='Created')
@@ -109,16 +124,14 @@ class SouthCarolinaShelters(BaseScraper):
         return message
 
     def fetch_data(self):
-        s = Soup(requests.get(self.url).content)
-        table = s.find('table')
-        trs = table.findAll('tr')
-        headings = [
-            th.getText()
-            for th in trs[0].findAll('th')
-        ]
+        return self.parse_shelters(self.fetch(self.url).content)
+
+    def parse_shelters(self, html):
+        rows = extract_table(html)
+        headings = [th.text for th in rows[0].ths]
         shelters = []
-        for tr in trs[1:]:
-            content = [td.getText() for td in tr.findAll('td')]
+        for row in rows[1:]:
+            content = [td.text for td in row.tds]
             shelters.append(dict(zip(headings, content)))
         return shelters
 
@@ -129,9 +142,8 @@ class ZeemapsScraper(BaseScraper):
     slack_channel = None
 
     def fetch_data(self):
-        data = requests.get(self.url).json()
-        data.sort(key=lambda d: d['nm'])
-        return data
+        data = self.fetch(self.url).json()
+        return sorted(data, key=lambda d: d['nm'])
 
 
 class FplStormOutages(BaseScraper):
@@ -140,7 +152,7 @@ class FplStormOutages(BaseScraper):
     slack_channel = None
 
     def fetch_data(self):
-        content = requests.get(
+        content = self.fetch(
             self.url,
             timeout=10,
         ).content
@@ -158,7 +170,7 @@ class FplCountyOutages(BaseScraper):
     slack_channel = None
 
     def fetch_data(self):
-        return requests.get(
+        return self.fetch(
             self.url,
             timeout=10,
         ).json()
@@ -171,7 +183,7 @@ class ScegOutages(BaseScraper):
     slack_channel = None
 
     def fetch_data(self):
-        data = requests.get(self.url).json()
+        data = self.fetch(self.url).json()
         return [feature['attributes'] for feature in data['features']]
 
 
@@ -182,7 +194,7 @@ class GeorgiaOutages(BaseScraper):
 
     def fetch_data(self):
         url = self.url + str(int(time.time()))
-        return requests.get(url).json()
+        return self.fetch(url, cache_key=self.url).json()
 
 
 class NorthGeorgiaOutages(BaseScraper):
@@ -191,7 +203,7 @@ class NorthGeorgiaOutages(BaseScraper):
     slack_channel = None
 
     def fetch_data(self):
-        return requests.get(self.url).json()
+        return self.fetch(self.url).json()
 
 
 class TampaElectricOutages(BaseScraper):
@@ -200,7 +212,7 @@ class TampaElectricOutages(BaseScraper):
     slack_channel = None
 
     def fetch_data(self):
-        return requests.get(
+        return self.fetch(
             self.url,
             headers={
                 'Referer': 'http://www.tampaelectric.com/residential/outages/outagemap/',
@@ -212,20 +224,33 @@ class JemcOutages(BaseScraper):
     filepath = 'jemc-outages.json'
     url = 'https://jemc.maps.sienatech.com/data/outages.xml'
     slack_channel = None
+    fingerprint = True
 
     def fetch_data(self):
-        et = ElementTree.fromstring(requests.get(self.url).content)
-        reports = et.find('reports').findall('report')
+        xml = self.fetch_file(self.url)
+        try:
+            return self.parse_reports(xml)
+        finally:
+            xml.close()
+
+    def parse_reports(self, xml):
+        # <reports><report id=".."><dimension><dim key=".."/></dimension>
+        # <dataset><t><e>value</e>...</t></dataset></report></reports>
         data = {}
-        for report in reports:
-            id = report.attrib['id']
-            keys = [d.attrib['key'] for d in report.findall('dimension/dim')]
-            rows = report.findall('dataset/t')
-            results = [
-                dict(zip(keys, [e.text for e in row]))
-                for row in rows
-            ]
-            data[id] = results
+        keys = []
+        rows = []
+        for element, ancestors in iter_elements(xml, ('dim', 't', 'report')):
+            path = [e.tag for e in ancestors[1:]]
+            if element.tag == 'dim' and path == ['reports', 'report', 'dimension']:
+                keys.append(element.attrib['key'])
+            elif element.tag == 't' and path == ['reports', 'report', 'dataset']:
+                rows.append([e.text for e in element])
+            elif element.tag == 'report' and path == ['reports']:
+                data[element.attrib['id']] = [
+                    dict(zip(keys, row)) for row in rows
+                ]
+                keys = []
+                rows = []
         return data
 
 
@@ -236,12 +261,15 @@ class BaseDukeScraper(BaseScraper):
         metadata_url = 'https://s3.amazonaws.com/outagemap.duke-energy.com/data/%s/external/interval_generation_data/metadata.xml?timestamp=%d' % (
             self.state_code, int(time.time())
         )
-        metadata = requests.get(metadata_url).content
+        # Both URLs carry a cache-buster, so key their validators without it
+        metadata = self.fetch(
+            metadata_url, cache_key=metadata_url.split('?')[0]
+        ).content
         directory = metadata.split('<directory>')[1].split('</directory>')[0]
         data_url = 'https://s3.amazonaws.com/outagemap.duke-energy.com/data/%s/external/interval_generation_data/%s/thematic/thematic_areas.js?timestamp=%d' % (
             self.state_code, directory, int(time.time())
         )
-        return requests.get(data_url).json()
+        return self.fetch(data_url, cache_key='thematic_areas.js').json()
 
 
 class DukeFloridaOutages(BaseDukeScraper):
@@ -280,7 +308,7 @@ class PascoCounty(BaseScraper):
         return message
 
     def fetch_data(self):
-        data = requests.post(self.url).json()
+        data = self.http.post(self.url).json()
         data.sort(key=lambda d: d['Name'])
         return data
 
@@ -334,16 +362,17 @@ class LedgerPolkCounty(BaseScraper):
         )
 
     def fetch_data(self):
-        s = Soup(requests.get(self.url).content)
-        trs = s.find('table').findAll('tr')[1:]
+        return self.parse_shelters(self.fetch(self.url).content)
+
+    def parse_shelters(self, html):
         shelters = []
-        for tr in trs:
-            tds = tr.findAll('td')
+        for row in extract_table(html)[1:]:
+            tds = row.tds
             shelters.append({
-                'name': tds[1].getText(),
+                'name': tds[1].text,
                 'url': 'http://www.ledgerdata.com/' + tds[1].find('a')['href'],
-                'city': tds[2].getText(),
-                'type': tds[3].getText(),
+                'city': tds[2].text,
+                'type': tds[3].text,
             })
         return shelters
 
@@ -400,20 +429,22 @@ class HernandoCountyShelters(BaseScraper):
         )
 
     def fetch_data(self):
-        s = Soup(requests.get(self.url).content)
+        return self.parse_shelters(self.fetch(self.url).content)
+
+    def parse_shelters(self, html):
         shelters = []
-        for tr in s.find('table').findAll('tr'):
-            tds = tr.findAll('td')
+        for row in extract_table(html):
+            tds = row.tds
             img = tds[1].find('img')
             if img is not None:
                 shelter_type = img['alt'].title()
             else:
                 shelter_type = 'General'
             shelters.append({
-                'name': tds[2].getText(),
+                'name': tds[2].text,
                 'type': shelter_type,
-                'address': tds[3].getText(),
-                'status': tds[4].getText(),
+                'address': tds[3].text,
+                'status': tds[4].text,
             })
         return shelters
 
@@ -445,24 +476,32 @@ def update_message_from_names(current_names, previous_names, filepath, verb='Upd
     return summary_text + '\n\n' + body
 
 
-def is_heading(tr):
-    return tr.findAll('td')[1].text == 'Shelter Name'
+def is_heading(tds):
+    return tds[1].text == 'Shelter Name'
 
 
-def is_shelter(tr):
-    return len(tr.findAll('td')) == 4 and not is_heading(tr)
+def is_shelter(tds):
+    return len(tds) == 4 and not is_heading(tds)
 
 
-def is_county_heading(tr):
-    if tr.find('td').get('colspan') == '5' and (u'#d4d4d4' in tr.find('td').get('style', '')) and tr.text != '&nbsp;':
-        return tr.text
+def is_county_heading(row, tds):
+    if tds and tds[0].get('colspan') == '5' and (u'#d4d4d4' in tds[0].get('style', '')) and row.text != '&nbsp;':
+        return row.text
     else:
         return None
 
 
+hidden_input_re = re.compile(r'<input[^>]+type="hidden"[^>]*>', re.I)
+
+
 class FloridaDisasterShelters(BaseScraper):
     filepath = 'florida-shelters.json'
     url = 'http://www.floridadisaster.org/shelters/summary.aspx'
+    fingerprint = True
+
+    def normalize_content(self, content):
+        # ASP.NET regenerates __VIEWSTATE and friends on every request
+        return hidden_input_re.sub('', content)
 
     def update_message(self, old_data, new_data):
         def name(n):
@@ -475,25 +514,28 @@ class FloridaDisasterShelters(BaseScraper):
         return message
 
     def fetch_data(self):
-        r = requests.get(self.url)
+        r = self.fetch(self.url)
         if r.status_code != 200:
             print "Oh no - status code = %d" % r.status_code
             return None
-        table = Soup(r.content).findAll('table')[9]
+        return self.parse_shelters(r.content)
+
+    def parse_shelters(self, html):
         current_county = None
         shelters = []
-        for tr in table.findAll('tr'):
-            heading = is_county_heading(tr)
+        for row in extract_table(html, index=9):
+            tds = row.tds
+            heading = is_county_heading(row, tds)
             if heading:
                 current_county = heading
-            if is_shelter(tr):
+            if is_shelter(tds):
                 shelters.append({
-                    'type': tr.findAll('td')[0].text,
+                    'type': tds[0].text,
                     'county': current_county.title(),
-                    'name': tr.findAll('td')[1].text,
-                    'address': tr.findAll('td')[2].text,
-                    'map_url': tr.findAll('td')[2].find('a')['href'].split(' ')[0],
-                    'city': tr.findAll('td')[3].text,
+                    'name': tds[1].text,
+                    'address': tds[2].text,
+                    'map_url': tds[2].find('a')['href'].split(' ')[0],
+                    'city': tds[3].text,
                 })
         shelters.sort(key=lambda s: (s['county'], s['name']))
         return shelters
@@ -505,9 +547,10 @@ class CrowdSourceRescue(BaseScraper):
     repo = 'private-irma-data'
     slack_channel = None
     url = 'https://crowdsourcerescue.com/rescuees/searchApi/'
+    compact_records = True
 
     def fetch_data(self):
-        return requests.post(self.url, {
+        return self.http.post(self.url, {
             'needstring': '',
             'lat_min': '23.882475192722612',
             'lat_max': '29.761185051094046',
@@ -521,8 +564,38 @@ if __name__ == '__main__':
     test_mode = ('--test' in sys.argv)
     github_token = os.environ.get('GITHUB_API_TOKEN', '')
     slack_token = os.environ.get('SLACK_TOKEN', '')
+    # Validators for conditional requests live on disk, to survive restarts
+    http = HttpClient(
+        cache_dir=os.environ.get('HTTP_CACHE_DIR', '.http-cache'),
+    )
+    # Last committed data for each file, so restarts don't re-read them all
+    state = StateStore(os.environ.get('SCRAPER_STATE_DIR', '.scraper-state'))
+    # Set LOCAL_GIT_ROOT to commit into local bare repositories instead of
+    # through the GitHub API, and LOCAL_GIT_PUSH_INTERVAL to push those to
+    # their "origin" remote every so many seconds. Pushing needs each one
+    # to be a bare clone, e.g. git clone --bare <url> $LOCAL_GIT_ROOT/o/r.git
+    # - without it they are only local, and Slack posts don't link to them
+    local_git_root = os.environ.get('LOCAL_GIT_ROOT')
+    push_interval = os.environ.get('LOCAL_GIT_PUSH_INTERVAL')
+    local_repositories = {}
+
+    def storage_for(klass):
+        if not local_git_root:
+            return None
+        key = (klass.owner, klass.repo)
+        if key not in local_repositories:
+            local_repositories[key] = LocalGitRepository(
+                os.path.join(local_git_root, klass.owner, klass.repo + '.git'),
+                remote='origin' if push_interval else None,
+                push_interval=int(push_interval) if push_interval else None,
+            )
+        return local_repositories[key]
+
     scrapers = [
-        klass(github_token, slack_token)
+        klass(
+            github_token, slack_token,
+            http=http, storage=storage_for(klass), state=state,
+        )
         for klass in (
             SantaRosaEmergencyInformation,
             SonomaRoadConditions,
@@ -556,18 +629,14 @@ if __name__ == '__main__':
             PGEOutagesIndividual,
         )
     ]
-    while True:
-        print datetime.datetime.now()
-        for scraper in scrapers:
-            if test_mode and not scraper.test_mode:
-                continue
-            try:
-                scraper.scrape_and_store()
-            except Exception, e:
-                print "!!!! %s: %s !!!!!" % (
-                    scraper.__class__.__name__, e
-                )
-                if test_mode:
-                    import pdb; pdb.post_mortem()
-
-        time.sleep(120)
+    runner = CycleRunner(
+        [
+            scraper for scraper in scrapers
+            if scraper.test_mode or not test_mode
+        ],
+        debug=test_mode,
+        http=http,
+        # Commit everything that changed in a cycle together
+        batch_commits=not test_mode,
+    )
+    AdaptiveScheduler(runner).run_forever()
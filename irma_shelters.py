@@ -1,7 +1,12 @@
 from base_scraper import BaseScraper
-import requests
+from diff import diff_records
+from http_client import default_client
+from operator import itemgetter
+from spatial import GridIndex, KDTree, connected_groups
 import Geohash
+import hashlib
 import re
+import time
 
 IGNORE_DUPE_IDS = {
     456, # Hialeah Middle School
@@ -52,34 +57,26 @@ class IrmaShelters(BaseScraper):
         return summary_text + '\n\n' + body
 
     def fetch_data(self):
-        data = requests.get(self.url).json()
-        shelters = data['shelters']
-        shelters.sort(key=lambda s: s['shelter'])
-        return shelters
+        data = self.fetch(self.url).json()
+        return sorted(data['shelters'], key=lambda s: s['shelter'])
 
 
 class IrmaShelterDupes(BaseScraper):
     # Detect possible dupes in irma-api
     filepath = 'irma-shelters-dupes.json'
     url = 'https://irma-api.herokuapp.com/api/v1/shelters'
+    # Shelters closer together than this, in metres, are potential dupes
+    dupe_distance = 100
 
     def update_message(self, old_data, new_data):
-        previous_geohashes = [
-            dupe_group['geohash'] for dupe_group in old_data['dupe_groups']
-        ]
-        current_geohashes = [
-            dupe_group['geohash'] for dupe_group in new_data['dupe_groups']
-        ]
-        added_geohashes = [
-            geohash for geohash in current_geohashes if geohash not in previous_geohashes
-        ]
-        removed_geohashes = [
-            geohash for geohash in previous_geohashes if geohash not in current_geohashes
-        ]
+        groups = diff_records(
+            old_data['dupe_groups'],
+            new_data['dupe_groups'],
+            key=dupe_group_key,
+        )
 
         message = []
-        for geohash in added_geohashes:
-            dupe_group = [group for group in new_data['dupe_groups'] if group['geohash'] == geohash][0]
+        for dupe_group in groups.added:
             message.append('New potential duplicates:')
             for shelter in dupe_group['shelters']:
                 message.append('  ' + shelter['name'])
@@ -89,11 +86,10 @@ class IrmaShelterDupes(BaseScraper):
                 message.append('    ' + shelter['view_url'])
                 message.append('')
 
-        if added_geohashes and removed_geohashes:
+        if groups.added and groups.removed:
             message.append('')
 
-        for geohash in removed_geohashes:
-            dupe_group = [group for group in old_data['dupe_groups'] if group['geohash'] == geohash][0]
+        for dupe_group in groups.removed:
             message.append('This previous duplicate looks to be resolved:')
             for shelter in dupe_group['shelters']:
                 message.append('  ' + shelter['name'])
@@ -103,68 +99,55 @@ class IrmaShelterDupes(BaseScraper):
                 message.append('    ' + shelter['view_url'])
                 message.append('')
 
-        current_no_latlon_ids = [
-            shelter['id'] for shelter in new_data['no_latitude_longitude']
-        ]
         # Older data in our repo doesn't have the 'id' property, so we
         # have to allow it to be None here
-        previous_no_latlon_ids = [
-            shelter.get('id') for shelter in old_data['no_latitude_longitude']
-        ]
-
-        new_no_latlon_ids = [
-            id for id in current_no_latlon_ids
-            if id not in previous_no_latlon_ids
-        ]
-        resolved_no_latlon_ids = [
-            id for id in previous_no_latlon_ids
-            if id not in current_no_latlon_ids
-            and id is not None
+        no_latlons = diff_records(
+            old_data['no_latitude_longitude'],
+            new_data['no_latitude_longitude'],
+            key=itemgetter('id'),
+            old_key=lambda shelter: shelter.get('id'),
+        )
+        new_no_latlons = no_latlons.added
+        resolved_no_latlons = [
+            shelter for shelter in no_latlons.removed
+            if shelter.get('id') is not None
         ]
 
-        if new_no_latlon_ids:
+        if new_no_latlons:
             message.append('')
             message.append('New shelters detected with no latitude/longitude:')
-            for id in new_no_latlon_ids:
-                shelter = [
-                    s for s in new_data['no_latitude_longitude']
-                    if s['id'] == id
-                ][0]
+            for shelter in new_no_latlons:
                 message.append('    ' + shelter['name'])
                 if shelter.get('address'):
                     message.append('    ' + shelter['address'])
                 message.append('    ' + shelter['view_url'])
                 message.append('')
 
-        if resolved_no_latlon_ids:
+        if resolved_no_latlons:
             message.append('')
             message.append('Fixed shelters that had no latitude/longitude:')
-            for id in resolved_no_latlon_ids:
-                shelter = [
-                    s for s in old_data['no_latitude_longitude']
-                    if s['id'] == id
-                ][0]
+            for shelter in resolved_no_latlons:
                 message.append('  ' + shelter['name'])
                 message.append('  ' + (shelter.get('address') or ''))
                 message.append('  ' + shelter['view_url'])
 
         body = '\n'.join(message)
         summary = []
-        if added_geohashes:
+        if groups.added:
             summary.append('%d new dupe%s detected' % (
-                len(added_geohashes), '' if len(added_geohashes) == 1 else 's',
+                len(groups.added), '' if len(groups.added) == 1 else 's',
             ))
-        if removed_geohashes:
+        if groups.removed:
             summary.append('%d dupe%s resolved' % (
-                len(removed_geohashes), '' if len(removed_geohashes) == 1 else 's',
+                len(groups.removed), '' if len(groups.removed) == 1 else 's',
             ))
-        if new_no_latlon_ids:
+        if new_no_latlons:
             summary.append('%d new no-lat-lon shelter%s' % (
-                len(new_no_latlon_ids), '' if len(new_no_latlon_ids) == 1 else 's',
+                len(new_no_latlons), '' if len(new_no_latlons) == 1 else 's',
             ))
-        if resolved_no_latlon_ids:
+        if resolved_no_latlons:
             summary.append('%d fixed no-lat-lon shelter%s' % (
-                len(resolved_no_latlon_ids), '' if len(resolved_no_latlon_ids) == 1 else 's',
+                len(resolved_no_latlons), '' if len(resolved_no_latlons) == 1 else 's',
             ))
         if summary:
             summary_text = self.filepath + ': ' + (', '.join(summary))
@@ -173,32 +156,44 @@ class IrmaShelterDupes(BaseScraper):
         return summary_text + '\n\n' + body
 
     def fetch_data(self):
-        data = requests.get(self.url).json()
-        shelters = data['shelters']
-        # Scan for potential dupes by lat/lon (using geohash)
-        by_geohash = {}
+        data = self.fetch(self.url).json()
+        return self.find_dupes(data['shelters'])
+
+    def find_dupes(self, shelters):
+        located = []
+        no_latlons = []
         for shelter in shelters:
             if shelter['id'] in IGNORE_DUPE_IDS:
                 continue
+            if has_no_latlon(shelter):
+                no_latlons.append(shelter)
+            else:
+                located.append(shelter)
+        # Scan for potential dupes: shelters within dupe_distance of each
+        # other, directly or via a chain of other shelters
+        index = GridIndex([
+            (shelter['latitude'], shelter['longitude'])
+            for shelter in located
+        ], self.dupe_distance)
+        groups = connected_groups(len(located), (
+            (i, j) for i, j, metres in index.pairs()
+        ))
+        dupe_groups = []
+        for group in groups:
+            members = [located[i] for i in group]
+            # Label each group with its lowest id shelter's geohash, so the
+            # same group keeps the same label from one run to the next
+            first = min(members, key=itemgetter('id'))
             geohash = Geohash.encode(
-                shelter['latitude'],
-                shelter['longitude'],
+                first['latitude'],
+                first['longitude'],
                 precision=GEOHASH_PRECISION,
             )
-            by_geohash.setdefault(geohash, []).append(shelter)
-        dupe_groups = [
-            pair for pair in by_geohash.items()
-            if (
-                # More than one shelter in this group
-                len(pair[1]) > 1
-                # Group is not invalid lat/lon
-                and pair[0] != ('0' * GEOHASH_PRECISION)
-            )
-        ]
-        no_latlons = by_geohash.get('0' * GEOHASH_PRECISION) or []
+            dupe_groups.append(((geohash, first['id']), geohash, members))
+        dupe_groups.sort(key=itemgetter(0))
         return {
             'dupe_groups': [{
-                'geohash': dupe_group[0],
+                'geohash': dupe_group[1],
                 'shelters': [{
                     'id': shelter['id'],
                     'name': shelter['shelter'],
@@ -207,7 +202,7 @@ class IrmaShelterDupes(BaseScraper):
                     'longitude': shelter['longitude'],
                     'google_maps': 'https://www.google.com/maps/search/%(latitude)s,%(longitude)s' % shelter,
                     'view_url': 'https://irma-api.herokuapp.com/shelters/%s' % shelter['id'],
-                } for shelter in dupe_group[1]],
+                } for shelter in dupe_group[2]],
             } for dupe_group in dupe_groups],
             'no_latitude_longitude': [{
                 'id': shelter['id'],
@@ -218,6 +213,26 @@ class IrmaShelterDupes(BaseScraper):
         }
 
 
+def dupe_group_key(dupe_group):
+    # Separate groups can share a geohash cell, but never a shelter
+    return (
+        dupe_group['geohash'],
+        min(shelter['id'] for shelter in dupe_group['shelters']),
+    )
+
+
+def has_no_latlon(shelter):
+    # Shelters without a location sit in the all-zeros geohash cell, in the
+    # far south-west corner - only worth encoding if they are down there
+    if shelter['latitude'] > -89:
+        return False
+    return Geohash.encode(
+        shelter['latitude'],
+        shelter['longitude'],
+        precision=GEOHASH_PRECISION,
+    ) == '0' * GEOHASH_PRECISION
+
+
 map_url_re = re.compile(
     r'http://maps.google.com/maps\?saddr=&daddr=-?\d+\.\d+,-?\d+\.\d+'
 )
@@ -228,63 +243,80 @@ class IrmaSheltersFloridaMissing(BaseScraper):
     our_url = 'https://raw.githubusercontent.com/simonw/disaster-data/master/irma-shelters.json'
     their_url = 'https://raw.githubusercontent.com/simonw/disaster-data/master/florida-shelters.json'
     issue_comments_url = 'https://api.github.com/repos/simonw/disaster-data/issues/2/comments'
+    # Their shelters further than this, in metres, from all of ours are
+    # reported as potentially missing
+    match_distance = 200
+    # Used straight from IrmaShelters and FloridaDisasterShelters when they
+    # run alongside this, otherwise downloaded from our_url and their_url
+    depends_on = ('irma-shelters.json', 'florida-shelters.json')
+
+    def __init__(self, *args, **kwargs):
+        super(IrmaSheltersFloridaMissing, self).__init__(*args, **kwargs)
+        # map_url -> (latitude, longitude), and our shelters' index, kept
+        # between runs
+        self._coordinates = {}
+        self._index = None
+        # Their shelters mentioned in comments on the issue are ignored
+        self.comment_index = IssueCommentIndex(
+            self.issue_comments_url,
+            self.github_token,
+            http=self.http,
+            state=self.state,
+            state_key=(self.owner, self.repo, self.filepath + ' comments'),
+        )
+
+    def inputs_changed(self):
+        # The map_urls mentioned in the issue comments are an input too, so
+        # bring those up to date here
+        self.comment_index.update()
+        self.input_versions[self.issue_comments_url] = self.comment_index.version()
+        return super(IrmaSheltersFloridaMissing, self).inputs_changed()
 
     def create_message(self, new_data):
         return self.update_message([], new_data, 'Created')
 
     def update_message(self, old_data, new_data, verb='Updated'):
-        previous_map_urls = [
-            d['map_url'] for d in old_data
-        ]
-        current_map_urls = [
-            d['map_url'] for d in new_data
-        ]
-        added_map_urls = [
-            map_url for map_url in current_map_urls
-            if map_url not in previous_map_urls
-        ]
-        removed_map_urls = [
-            map_url for map_url in previous_map_urls
-            if map_url not in current_map_urls
-        ]
+        diff = diff_records(old_data, new_data, key=itemgetter('map_url'))
 
         message = []
 
-        if added_map_urls:
+        if diff.added:
             message.append('New potentially missing shelters:')
 
-        for map_url in added_map_urls:
-            shelter = [s for s in new_data if s['map_url'] == map_url][0]
+        for shelter in diff.added:
             message.append('  %s (%s County)' % (shelter['name'], shelter['county']))
             message.append('  Type: ' + shelter['type'])
             message.append('  ' + shelter['address'])
             message.append('  ' + shelter['city'])
             message.append('  ' + shelter['map_url'])
+            if shelter.get('nearest_shelter'):
+                message.append('  Nearest: %s, %dm away' % (
+                    shelter['nearest_shelter'], shelter['nearest_distance']
+                ))
             message.append('')
 
-        if added_map_urls and removed_map_urls:
+        if diff.added and diff.removed:
             message.append('')
 
-        if removed_map_urls:
+        if diff.removed:
             message.append('Previous missing shelters now resolved:')
 
-        for map_url in removed_map_urls:
-            shelter = [s for s in old_data if s['map_url'] == map_url][0]
+        for shelter in diff.removed:
             message.append('  %s (%s County)' % (shelter['name'], shelter['county']))
 
         body = '\n'.join(message)
         summary = []
-        if added_map_urls:
+        if diff.added:
             summary.append('%d potentially missing shelter%s detected' % (
-                len(added_map_urls), '' if len(added_map_urls) == 1 else 's',
+                len(diff.added), '' if len(diff.added) == 1 else 's',
             ))
-        if removed_map_urls:
+        if diff.removed:
             summary.append('%d shelter%s resolved' % (
-                len(removed_map_urls), '' if len(removed_map_urls) == 1 else 's',
+                len(diff.removed), '' if len(diff.removed) == 1 else 's',
             ))
-        if current_map_urls:
+        if new_data:
             summary.append('%d total' % (
-                len(current_map_urls)
+                len(new_data)
             ))
         if summary:
             summary_text = self.filepath + ': ' + (', '.join(summary))
@@ -293,42 +325,172 @@ class IrmaSheltersFloridaMissing(BaseScraper):
         return summary_text + '\n\n' + body
 
     def fetch_data(self):
-        our_shelters = requests.get(self.our_url).json()
-        their_shelters = requests.get(self.their_url).json()
-        our_geohashes = set([
-            Geohash.encode(s['latitude'], s['longitude'], 6)
-            for s in our_shelters
-        ])
-        for shelter in their_shelters:
-            coords = shelter['map_url'].split('daddr=')[1]
-            latitude, longitude = map(float, coords.split(','))
-            geohash = Geohash.encode(latitude, longitude, 6)
-            shelter['geohash'] = geohash
-        maybe_missing_shelters = [
-            s for s in their_shelters
-            if s['geohash'] not in our_geohashes
-        ]
-        ignore_map_urls = []
-        for comment in all_comments(self.issue_comments_url, self.github_token):
-            ignore_map_urls.extend(map_url_re.findall(comment['body']))
+        our_shelters = self.input('irma-shelters.json', self.our_url)
+        their_shelters = self.input('florida-shelters.json', self.their_url)
+        maybe_missing_shelters = self.find_missing(our_shelters, their_shelters)
+        # scrape() has already brought comment_index up to date
+        ignore_map_urls = self.comment_index.map_urls()
         maybe_missing_shelters = [
             s for s in maybe_missing_shelters
             if s['map_url'] not in ignore_map_urls
         ]
         return maybe_missing_shelters
 
-
-def all_comments(issue_comments_url, github_token):
-    # Paginate through all comments on an issue
-    while issue_comments_url:
-        response = requests.get(
-            issue_comments_url,
-            headers={
-                'Authorization': 'token %s' % github_token,
-            })
-        try:
-            issue_comments_url = response.links['next']['url']
-        except KeyError:
-            issue_comments_url = None
-        for item in response.json():
-            yield item
+    def find_missing(self, our_shelters, their_shelters):
+        """
+        Their shelters with none of ours within match_distance, each with
+        the nearest of ours and how far away it is.
+        """
+        index = self.index_for(our_shelters)
+        coordinates = {}
+        missing = []
+        for shelter in their_shelters:
+            map_url = shelter['map_url']
+            latlon = self._coordinates.get(map_url) or map_url_latlon(map_url)
+            coordinates[map_url] = latlon
+            nearest = index.nearest(*latlon)
+            if nearest is not None and nearest[1] <= self.match_distance:
+                continue
+            shelter = dict(shelter, geohash=Geohash.encode(
+                latlon[0], latlon[1], 6
+            ))
+            if nearest is not None:
+                ours = our_shelters[nearest[0]]
+                shelter['nearest_shelter'] = '%s (%s)' % (
+                    ours['shelter'], ours['county']
+                )
+                shelter['nearest_distance'] = int(round(nearest[1]))
+            missing.append(shelter)
+        # Only remember the URLs still in use
+        self._coordinates = coordinates
+        return missing
+
+    def index_for(self, our_shelters):
+        "A KDTree of our shelters, reused if none of them have moved"
+        points = [(s['latitude'], s['longitude']) for s in our_shelters]
+        if self._index is None or self._index.points != points:
+            self._index = KDTree(points)
+        return self._index
+
+
+def map_url_latlon(map_url):
+    coords = map_url.split('daddr=')[1]
+    latitude, longitude = map(float, coords.split(','))
+    return latitude, longitude
+
+
+class IssueCommentIndex(object):
+    """
+    The map_urls mentioned in the comments on a GitHub issue, kept up to date
+    incrementally. Comments are only fetched in full every
+    full_rebuild_interval seconds - deleted comments are only noticed then.
+    In between we ask for comments updated since the newest one we have,
+    with the ETag from last time, so when nothing has changed that costs a
+    single 304. The map_urls from each comment are saved to a StateStore,
+    so a restart doesn't need a full fetch either.
+    """
+    per_page = 100
+    full_rebuild_interval = 60 * 60
+
+    def __init__(self, issue_comments_url, github_token, http=None, state=None, state_key=None):
+        self.issue_comments_url = issue_comments_url
+        self.github_token = github_token
+        self.http = http or default_client()
+        # state_key is an (owner, repo, filepath) tuple for state.save()
+        self.state = state
+        self.state_key = state_key
+        # comment id -> list of map_urls in that comment
+        self.comments = {}
+        self.since = None
+        self.etag = None
+        self.rebuilt_at = None
+        self.load()
+
+    def load(self):
+        if self.state is None:
+            return
+        saved = self.state.load(*self.state_key)
+        if saved is None or saved[0] != self.issue_comments_url:
+            return
+        data = saved[1]
+        self.comments = dict(
+            (int(id), map_urls) for id, map_urls in data['comments'].items()
+        )
+        self.since = data['since']
+        self.etag = data['etag']
+        self.rebuilt_at = data['rebuilt_at']
+
+    def save(self):
+        if self.state is None:
+            return
+        self.state.save(*self.state_key + (self.issue_comments_url, {
+            'comments': self.comments,
+            'since': self.since,
+            'etag': self.etag,
+            'rebuilt_at': self.rebuilt_at,
+        }))
+
+    def map_urls(self):
+        map_urls = set()
+        for comment_map_urls in self.comments.itervalues():
+            map_urls.update(comment_map_urls)
+        return map_urls
+
+    def version(self):
+        "Changes whenever map_urls() does"
+        return hashlib.sha1(
+            '\n'.join(sorted(self.map_urls()))
+        ).hexdigest()
+
+    def update(self):
+        rebuild = (
+            self.rebuilt_at is None or
+            time.time() - self.rebuilt_at > self.full_rebuild_interval
+        )
+        if rebuild:
+            etag, comments = self.fetch({'per_page': self.per_page})
+            self.comments = {}
+            self.since = None
+            self.rebuilt_at = time.time()
+        else:
+            etag, comments = self.fetch({
+                'per_page': self.per_page,
+                'since': self.since,
+            }, self.etag)
+            if comments is None:
+                return
+        since = self.since
+        for comment in comments:
+            self.comments[comment['id']] = map_url_re.findall(comment['body'])
+            since = max(since, comment['updated_at'])
+        # The ETag is only any use while we keep asking for the same since
+        self.etag = etag if since == self.since else None
+        self.since = since
+        self.save()
+
+    def fetch(self, params, etag=None):
+        """
+        Walks every page, returning (ETag of the first page, comments) - or
+        (etag, None) if the server says nothing has changed
+        """
+        headers = {
+            'Authorization': 'token %s' % self.github_token,
+        }
+        response = self.http.get(
+            self.issue_comments_url,
+            params=params,
+            headers=dict(headers, **({'If-None-Match': etag} if etag else {})),
+        )
+        if response.status_code == 304:
+            response.close()
+            return etag, None
+        response.raise_for_status()
+        first_etag = response.headers.get('ETag')
+        comments = response.json()
+        while 'next' in response.links:
+            response = self.http.get(
+                response.links['next']['url'], headers=headers
+            )
+            response.raise_for_status()
+            comments.extend(response.json())
+        return first_etag, comments
@@ -0,0 +1,194 @@
+"""
+A storage backend that commits straight into a local git repository, as an
+alternative to writing through the GitHub API with GithubContent.
+
+It offers the same read() / blob_sha() / write() / write_many() methods as
+GithubContent, but uses git plumbing commands - hash-object, update-index
+against a private index file, write-tree, commit-tree and update-ref - so
+there is no working tree to check out and no limit on file sizes. Commits can
+optionally be pushed to a remote every push_interval seconds; CycleRunner
+calls maybe_push() after every cycle, so unpushed commits don't have to wait
+for the next write.
+"""
+import os
+import subprocess
+import tempfile
+import threading
+import time
+
+
+class LocalGitRepository(object):
+    class NotFound(Exception):
+        pass
+
+    class GitError(Exception):
+        pass
+
+    class Conflict(Exception):
+        "A file changed in the repository since the sha we were given"
+        pass
+
+    default_committer = {
+        'name': 'irma-scraper',
+        'email': 'irma-scraper@example.com',
+    }
+
+    def __init__(self, path, branch='master', remote=None, push_interval=None):
+        self.path = path
+        self.branch = branch
+        self.remote = remote
+        self.push_interval = push_interval
+        self.last_push = time.time()
+        # True while there are commits the remote hasn't got yet
+        self.unpushed = False
+        self._lock = threading.Lock()
+        if not os.path.exists(os.path.join(path, 'HEAD')):
+            self.git('init', '--bare', '--quiet', path, git_dir=False)
+        # remote can be a URL, or the name of one of the repository's remotes
+        named = remote and '/' not in remote and ':' not in remote
+        if named and remote not in self.git('remote').split():
+            # A fresh "git init" has nothing to push to - clone the
+            # repository with "git clone --bare" instead
+            raise self.GitError('%s has no remote called %s' % (path, remote))
+
+    def git(self, *args, **kwargs):
+        # input can be a string, or anything with a chunks() method such as
+        # serialization.SerializedContent
+        input = kwargs.pop('input', None)
+        env = dict(os.environ)
+        env.update(kwargs.pop('env', None) or {})
+        command = ['git']
+        if kwargs.pop('git_dir', True):
+            command.append('--git-dir=%s' % self.path)
+        command.extend(args)
+        process = subprocess.Popen(
+            command,
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            env=env,
+        )
+        if hasattr(input, 'chunks'):
+            # Stream it in, rather than building one big string
+            for chunk in input.chunks():
+                process.stdin.write(chunk)
+            input = None
+        stdout, stderr = process.communicate(input)
+        if process.returncode != 0:
+            raise self.GitError('%s: %s' % (' '.join(args), stderr.strip()))
+        return stdout
+
+    def head(self):
+        try:
+            return self.git(
+                'rev-parse', '--verify', '--quiet', 'refs/heads/%s' % self.branch
+            ).strip()
+        except self.GitError:
+            return None
+
+    def blob_sha(self, filepath):
+        head = self.head()
+        if head is None:
+            raise self.NotFound(filepath)
+        listing = self.git('ls-tree', head, '--', filepath).strip()
+        if not listing:
+            raise self.NotFound(filepath)
+        return listing.split()[2]
+
+    def read(self, filepath):
+        sha = self.blob_sha(filepath)
+        return self.git('cat-file', 'blob', sha), sha
+
+    def write(self, filepath, content, sha=None, commit_message=None, committer=None):
+        commit_sha, shas = self.write_many(
+            [(filepath, content, sha)],
+            commit_message=commit_message,
+            committer=committer,
+        )
+        return shas[filepath], commit_sha
+
+    def write_many(self, files, commit_message=None, committer=None):
+        """
+        Commits several files in one go. files is a list of (filepath, content)
+        pairs, or (filepath, content, sha) where sha is the blob sha the file
+        should have before the commit - Conflict is raised if it doesn't.
+        Returns (commit_sha, {filepath: blob_sha}).
+        """
+        committer = committer or self.default_committer
+        env = {
+            'GIT_AUTHOR_NAME': committer['name'],
+            'GIT_AUTHOR_EMAIL': committer['email'],
+            'GIT_COMMITTER_NAME': committer['name'],
+            'GIT_COMMITTER_EMAIL': committer['email'],
+        }
+        with self._lock:
+            for file in files:
+                if len(file) > 2 and file[2] is not None:
+                    try:
+                        current_sha = self.blob_sha(file[0])
+                    except self.NotFound:
+                        current_sha = None
+                    if current_sha != file[2]:
+                        raise self.Conflict('%s is at %s, not %s' % (
+                            file[0], current_sha, file[2]
+                        ))
+            shas = {}
+            for file in files:
+                filepath, content = file[:2]
+                if isinstance(content, unicode):
+                    content = content.encode('utf8')
+                shas[filepath] = self.git(
+                    'hash-object', '-w', '--stdin', input=content
+                ).strip()
+            head = self.head()
+            # Build the new tree in a throwaway index, never a working tree
+            fd, index_path = tempfile.mkstemp(prefix='scraper-index-')
+            os.close(fd)
+            os.remove(index_path)
+            env['GIT_INDEX_FILE'] = index_path
+            try:
+                if head is not None:
+                    self.git('read-tree', head, env=env)
+                for filepath, sha in sorted(shas.items()):
+                    self.git(
+                        'update-index', '--add', '--cacheinfo',
+                        '100644,%s,%s' % (sha, filepath),
+                        env=env,
+                    )
+                tree = self.git('write-tree', env=env).strip()
+            finally:
+                if os.path.exists(index_path):
+                    os.remove(index_path)
+            del env['GIT_INDEX_FILE']
+            args = ['commit-tree', tree]
+            if head is not None:
+                args.extend(['-p', head])
+            message = commit_message or 'Update'
+            if isinstance(message, unicode):
+                message = message.encode('utf8')
+            commit_sha = self.git(*args, input=message, env=env).strip()
+            self.git(
+                'update-ref', 'refs/heads/%s' % self.branch, commit_sha,
+                head or '',
+            )
+            self.unpushed = True
+        self.maybe_push()
+        return commit_sha, shas
+
+    def maybe_push(self):
+        "Pushes if there are unpushed commits and push_interval has passed"
+        if not self.remote or self.push_interval is None or not self.unpushed:
+            return
+        if time.time() - self.last_push < self.push_interval:
+            return
+        self.last_push = time.time()
+        # Cleared first, so a commit made during the push is pushed next time
+        with self._lock:
+            self.unpushed = False
+        try:
+            self.git('push', '--quiet', self.remote, self.branch)
+        except self.GitError, e:
+            with self._lock:
+                self.unpushed = True
+            # Try again next time, the commits are safe locally
+            print '!!!! Push to %s failed: %s !!!!!' % (self.remote, e)
@@ -1,19 +1,20 @@
 from base_scraper import BaseScraper, BaseDeltaScraper
 from BeautifulSoup import Comment, BeautifulSoup as Soup
-from xml.etree import ElementTree
-import requests
+from html_tables import extract_tables
+from xml_stream import KML, iter_elements
 import re
 
 
 class PGEOutagesIndividual(BaseDeltaScraper):
     url = 'https://apim.pge.com/cocoutage/outages/getOutagesRegions?regionType=city&expand=true'
     filepath = 'pge-outages-individual.json'
+    compact_records = True
     slack_channel = None
     record_key = 'outageNumber'
     noun = 'outage'
 
     def fetch_data(self):
-        data = requests.get(
+        data = self.fetch(
             self.url,
             timeout=10,
         ).json()
@@ -21,8 +22,7 @@ class PGEOutagesIndividual(BaseDeltaScraper):
         outages = []
         for region in data['outagesRegions']:
             for outage in region['outages']:
-                outage['regionName'] = region['regionName']
-                outages.append(outage)
+                outages.append(dict(outage, regionName=region['regionName']))
         return outages
 
     def display_record(self, outage):
@@ -38,9 +38,15 @@ class SantaRosaEmergencyInformation(BaseScraper):
     url = 'https://srcity.org/610/Emergency-Information'
     filepath = 'santa-rosa-emergency.json'
     slack_channel = None
+    fingerprint = True
+
+    def normalize_content(self, content):
+        # fetch_data() throws away scripts and comments, which is where the
+        # cache-busters and render timestamps live
+        return comment_re.sub('', script_re.sub('', content))
 
     def fetch_data(self):
-        html = requests.get(self.url).content
+        html = self.fetch(self.url).content
         soup = Soup(html)
         main_content = soup.find('div', {'data-cprole': 'mainContentContainer'})
         # Remove scripts
@@ -70,17 +76,20 @@ class SonomaRoadConditions(BaseScraper):
     slack_channel = None
 
     def fetch_data(self):
-        soup = Soup(requests.get(self.url).content)
+        return self.parse_closures(self.fetch(self.url).content)
+
+    def parse_closures(self, html):
+        ids = ('divTableCounty', 'divTableCity')
+        tables = extract_tables(html, *[{'within': {'id': id}} for id in ids])
         road_closures = {}
-        for id in ('divTableCounty', 'divTableCity'):
+        for id, rows in zip(ids, tables):
             name = {'divTableCounty': 'county_roads', 'divTableCity': 'city_roads'}[id]
-            div = soup.find('div', {'id': id})
-            table = div.find('table')
-            headers = [th.text for th in table.findAll('th')]
+            headers = [th.text for row in rows for th in row.ths]
             closures = []
-            for tr in table.find('tbody').findAll('tr'):
-                values = [td.text for td in tr.findAll('td')]
-                closures.append(dict(zip(headers, values)))
+            for row in rows:
+                if row.section == 'tbody':
+                    values = [td.text for td in row.tds]
+                    closures.append(dict(zip(headers, values)))
             road_closures[name] = closures
         return road_closures
 
@@ -91,7 +100,7 @@ class CaliforniaDOTRoadInfo(BaseScraper):
     slack_channel = None
 
     def fetch_data(self):
-        text = requests.get(self.url).content
+        text = self.fetch(self.url).content
         return {
             'text_lines': [l.rstrip('\r') for l in text.split('\n')],
         }
@@ -113,24 +122,32 @@ class CaliforniaHighwayPatrolIncidents(BaseDeltaScraper):
         return '\n'.join(display)
 
     def fetch_data(self):
-        kml = requests.get(self.url).content
-        et = ElementTree.fromstring(kml)
-        incidents = []
-        for placemark in et.findall('.//{http://www.opengis.net/kml/2.2}Placemark'):
-            coords = placemark.find('.//{http://www.opengis.net/kml/2.2}coordinates').text.strip()
+        # Parse the KML as it arrives rather than downloading it first
+        response = self.fetch(self.url, stream=True)
+        try:
+            response.raise_for_status()
+            response.raw.decode_content = True
+            return list(self.parse_incidents(response.raw))
+        finally:
+            response.close()
+
+    def parse_incidents(self, kml):
+        for placemark, _ in iter_elements(kml, KML + 'Placemark'):
+            coords = placemark.find('.//' + KML + 'coordinates').text.strip()
             latitude, longitude, blah = map(float, coords.split(','))
-            description = placemark.find('{http://www.opengis.net/kml/2.2}description').text.strip()
-            name = placemark.find('{http://www.opengis.net/kml/2.2}name').text.strip()
-            incidents.append({
+            description = placemark.find(KML + 'description').text.strip()
+            name = placemark.find(KML + 'name').text.strip()
+            yield {
                 'name': name,
                 'description': strip_tags(description),
                 'latitude': latitude,
                 'longitude': longitude,
-            })
-        return incidents
+            }
 
 
 tag_re = re.compile('<.*?>')
+script_re = re.compile(r'<script.*?</script>', re.I | re.S)
+comment_re = re.compile(r'<!--.*?-->', re.S)
 
 
 def strip_tags(s):
@@ -1,9 +1,9 @@
 # In case a hurricane hits New York...
 from base_scraper import BaseDeltaScraper
+from projections import reproject
 
-import requests
 import csv
-from pyproj import Proj, transform
+from itertools import izip
 
 
 class NewYorkShelters(BaseDeltaScraper):
@@ -23,22 +23,24 @@ class NewYorkShelters(BaseDeltaScraper):
         return '\n'.join(display)
 
     def fetch_data(self):
-        data = requests.get(self.url).content
-        rows = csv.reader(data.split('\r\n'))
-        headers = next(rows)
-        shelters = []
-        from_projection = Proj(init='epsg:2263', preserve_units=True)
-        to_projection = Proj(proj='latlong', ellps='WGS84', datum='WGS84')
-        for row in rows:
-            shelter = dict(zip(headers, row))
-            if not shelter:
-                continue
-            # Convert from epsg:2263 - preserve_units=True because this is in feet
-            x, y = shelter['X'], shelter['Y']
-            longitude, latitude = transform(
-                from_projection, to_projection, x, y
-            )
+        # Parse the CSV as it downloads
+        response = self.fetch(self.url, stream=True)
+        try:
+            response.raise_for_status()
+            rows = csv.reader(response.iter_lines(delimiter='\r\n'))
+            headers = next(rows)
+            shelters = [dict(zip(headers, row)) for row in rows]
+        finally:
+            response.close()
+        shelters = [shelter for shelter in shelters if shelter]
+        # Convert from epsg:2263 - preserve_units=True because this is in feet
+        longitudes, latitudes = reproject(
+            [shelter['X'] for shelter in shelters],
+            [shelter['Y'] for shelter in shelters],
+            init='epsg:2263',
+            preserve_units=True,
+        )
+        for shelter, longitude, latitude in izip(shelters, longitudes, latitudes):
             shelter['longitude'] = longitude
             shelter['latitude'] = latitude
-            shelters.append(shelter)
         return shelters
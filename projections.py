@@ -0,0 +1,43 @@
+"""
+Reprojection of coordinates from projected systems - state plane and the
+like - to latitude/longitude.
+
+pyproj.Proj objects are expensive to build, so they are created once per
+process and reused. reproject() converts whole columns of coordinates in a
+single pyproj call rather than one call per point.
+"""
+from array import array
+from pyproj import Proj, transform
+import threading
+
+WGS84 = {'proj': 'latlong', 'ellps': 'WGS84', 'datum': 'WGS84'}
+
+_projections = {}
+_lock = threading.Lock()
+
+
+def projection(**kwargs):
+    "A shared pyproj.Proj for these arguments"
+    key = tuple(sorted(kwargs.items()))
+    with _lock:
+        proj = _projections.get(key)
+        if proj is None:
+            proj = _projections[key] = Proj(**kwargs)
+    return proj
+
+
+def reproject(xs, ys, target=None, **source):
+    """
+    Transforms sequences of x and y coordinates - numbers or numeric
+    strings - from the projection described by the source keyword
+    arguments, e.g. init='epsg:2263', to target (WGS84 by default).
+
+    Returns (longitudes, latitudes) as two arrays of floats.
+    """
+    xs = array('d', (float(x) for x in xs))
+    ys = array('d', (float(y) for y in ys))
+    if not xs:
+        return xs, ys
+    return transform(
+        projection(**source), projection(**(target or WGS84)), xs, ys
+    )
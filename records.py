@@ -0,0 +1,132 @@
+"""
+Compact storage for large datasets made up of many similar records.
+
+A RecordSet is a list of Records. Each Record keeps its values in a tuple and
+points at a Schema - the tuple of keys, in the order the original dict had
+them - which is shared by every record with the same keys. Repeated strings
+such as county names, statuses and causes are interned, so each distinct
+value is stored once per dataset. Nested dicts and lists are compacted the
+same way.
+
+Records are read-only mappings, so display_record(), update_message() and
+diff_records() can use them just like dicts. Pass json_default as the
+default= argument to the json module to serialize them; the output is the
+same as for the dicts they were built from.
+"""
+from collections import Mapping, OrderedDict
+from itertools import izip
+
+_missing = object()
+
+
+class Schema(object):
+    __slots__ = ('keys', 'index')
+
+    def __init__(self, keys):
+        self.keys = keys
+        self.index = dict((key, i) for i, key in enumerate(keys))
+
+
+class Record(object):
+    __slots__ = ('_schema', '_values')
+
+    def __init__(self, schema, values):
+        self._schema = schema
+        self._values = values
+
+    def __getitem__(self, key):
+        return self._values[self._schema.index[key]]
+
+    def get(self, key, default=None):
+        i = self._schema.index.get(key)
+        if i is None:
+            return default
+        return self._values[i]
+
+    def __contains__(self, key):
+        return key in self._schema.index
+
+    has_key = __contains__
+
+    def __len__(self):
+        return len(self._values)
+
+    def __iter__(self):
+        return iter(self._schema.keys)
+
+    iterkeys = __iter__
+
+    def itervalues(self):
+        return iter(self._values)
+
+    def iteritems(self):
+        return izip(self._schema.keys, self._values)
+
+    def keys(self):
+        return list(self._schema.keys)
+
+    def values(self):
+        return list(self._values)
+
+    def items(self):
+        return zip(self._schema.keys, self._values)
+
+    def to_dict(self):
+        return OrderedDict(self.iteritems())
+
+    def __eq__(self, other):
+        if isinstance(other, Record) and other._schema is self._schema:
+            return self._values == other._values
+        if not isinstance(other, (Record, dict)) or len(other) != len(self):
+            return False
+        for key, value in self.iteritems():
+            if other.get(key, _missing) != value:
+                return False
+        return True
+
+    def __ne__(self, other):
+        return not self == other
+
+    __hash__ = None
+
+    def __repr__(self):
+        return 'Record(%r)' % dict(self.iteritems())
+
+
+Mapping.register(Record)
+
+
+class RecordSet(list):
+    "A list of Records sharing schemas and interned strings"
+    def __init__(self, records=()):
+        super(RecordSet, self).__init__()
+        self._schemas = {}
+        self._strings = {}
+        self.extend(self.compact(record) for record in records)
+
+    def compact(self, value):
+        if isinstance(value, (dict, Record)):
+            keys = tuple(self.intern(key) for key in value)
+            schema = self._schemas.get(keys)
+            if schema is None:
+                schema = self._schemas[keys] = Schema(keys)
+            return Record(schema, tuple(
+                self.compact(value[key]) for key in keys
+            ))
+        if isinstance(value, list):
+            return [self.compact(item) for item in value]
+        return self.intern(value)
+
+    def intern(self, value):
+        if isinstance(value, basestring):
+            return self._strings.setdefault(value, value)
+        return value
+
+    def append(self, record):
+        super(RecordSet, self).append(self.compact(record))
+
+
+def json_default(obj):
+    if isinstance(obj, Record):
+        return obj.to_dict()
+    raise TypeError('%r is not JSON serializable' % (obj,))
@@ -0,0 +1,437 @@
+"""
+Runs a cycle of scrapers concurrently.
+
+Each scraper's scrape_and_store() is called from a bounded pool of worker
+threads, with a limit on how many scrapers may talk to the same host at once.
+A slow or hanging source only holds up its own worker, so the wall time of a
+cycle approaches that of the slowest single scraper rather than the sum of
+all of them.
+
+With batch_commits=True the scrapers only scrape, and everything that changed
+during the cycle is then committed together - one commit per repository via
+the scrapers' storage.write_many() - instead of one commit per file.
+
+Scrapers can derive their data from other scrapers' outputs by listing those
+filepaths in depends_on. The runner treats that as a DAG: an upstream scraper
+always runs before the scrapers depending on it, and its fresh data is passed
+to them in memory rather than them downloading the last committed copy.
+Dependents of any scraper in a cycle join that cycle, and recompute only when
+one of their inputs changed.
+
+AdaptiveScheduler sits on top of that: rather than polling everything on the
+same fixed cadence it keeps a priority queue of next-due times, and tunes
+each scraper's interval based on how often its data actually changes.
+"""
+from common import PendingWrite
+import datetime
+import heapq
+import Queue
+import threading
+import time
+import urlparse
+
+
+def scraper_host(scraper):
+    url = getattr(scraper, 'url', None)
+    if not url:
+        return None
+    return urlparse.urlparse(url).netloc.lower() or None
+
+
+class CycleRunner(object):
+    max_workers = 8
+    max_per_host = 2
+
+    def __init__(self, scrapers, max_workers=None, max_per_host=None, debug=False, http=None, batch_commits=False):
+        self.scrapers = list(scrapers)
+        self.batch_commits = batch_commits
+        # Optional shared HttpClient, to report connection reuse per cycle and
+        # to forget its shared responses between cycles
+        self.http = http
+        if max_workers is not None:
+            self.max_workers = max_workers
+        if max_per_host is not None:
+            self.max_per_host = max_per_host
+        # In debug mode everything runs serially in the calling thread, so
+        # that pdb.post_mortem() can be used on failures
+        self.debug = debug
+        self._host_semaphores = {}
+        self._host_lock = threading.Lock()
+        self.by_filepath = dict(
+            (scraper.filepath, scraper) for scraper in self.scrapers
+        )
+        for scraper in self.scrapers:
+            for upstream in self.upstreams(scraper):
+                upstream.keep_output = True
+        # Fails early on a dependency cycle
+        self.dependency_order(self.scrapers)
+
+    def upstreams(self, scraper, among=None):
+        "The scrapers this one depends on, optionally only those in among"
+        upstreams = []
+        for filepath in scraper.depends_on:
+            upstream = self.by_filepath.get(filepath)
+            if upstream is not None and (among is None or upstream in among):
+                upstreams.append(upstream)
+        return upstreams
+
+    def with_dependents(self, scrapers):
+        "scrapers plus everything that depends on them, directly or not"
+        scrapers = list(scrapers)
+        included = set(scrapers)
+        added = True
+        while added:
+            added = False
+            for scraper in self.scrapers:
+                if scraper not in included and self.upstreams(scraper, included):
+                    scrapers.append(scraper)
+                    included.add(scraper)
+                    added = True
+        return scrapers
+
+    def dependency_order(self, scrapers):
+        "scrapers sorted so each comes after everything it depends on"
+        ordered = []
+        done = set()
+        remaining = list(scrapers)
+        while remaining:
+            ready = [
+                scraper for scraper in remaining
+                if all(u in done for u in self.upstreams(scraper, remaining + ordered))
+            ]
+            if not ready:
+                raise ValueError('Dependency cycle between %s' % ', '.join(
+                    scraper.filepath for scraper in remaining
+                ))
+            ordered.extend(ready)
+            done.update(ready)
+            remaining = [s for s in remaining if s not in done]
+        return ordered
+
+    def provide_inputs(self, scraper):
+        scraper.inputs = {}
+        scraper.input_versions = {}
+        for upstream in self.upstreams(scraper):
+            if upstream.output is not None:
+                scraper.inputs[upstream.filepath] = upstream.output
+                scraper.input_versions[upstream.filepath] = upstream.output_sha
+
+    def host_semaphore(self, host):
+        with self._host_lock:
+            if host not in self._host_semaphores:
+                self._host_semaphores[host] = threading.BoundedSemaphore(
+                    self.max_per_host
+                )
+            return self._host_semaphores[host]
+
+    def ordered(self, scrapers):
+        # Interleave scrapers by host, so workers rarely block waiting on a
+        # host that is already at its concurrency limit
+        by_host = {}
+        hosts = []
+        for scraper in scrapers:
+            host = scraper_host(scraper)
+            if host not in by_host:
+                hosts.append(host)
+            by_host.setdefault(host, []).append(scraper)
+        ordered = []
+        while any(by_host.values()):
+            for host in hosts:
+                if by_host[host]:
+                    ordered.append(by_host[host].pop(0))
+        return ordered
+
+    def run_one(self, scraper):
+        start = time.time()
+        if scraper.depends_on:
+            self.provide_inputs(scraper)
+        try:
+            if self.batch_commits:
+                outcome = scraper.scrape()
+            else:
+                outcome = scraper.scrape_and_store()
+            error = None
+        except Exception, e:
+            outcome = None
+            error = e
+            print "!!!! %s: %s !!!!!" % (
+                scraper.__class__.__name__, e
+            )
+            if self.debug:
+                import pdb; pdb.post_mortem()
+        return {
+            'scraper': scraper,
+            'outcome': outcome,
+            'error': error,
+            'duration': time.time() - start,
+        }
+
+    def worker(self, queue, results, finished):
+        while True:
+            scraper = queue.get()
+            if scraper is None:
+                return
+            host = scraper_host(scraper)
+            if host is None:
+                results.append(self.run_one(scraper))
+            else:
+                with self.host_semaphore(host):
+                    results.append(self.run_one(scraper))
+            finished(scraper)
+
+    def run_cycle(self, scrapers=None):
+        "Runs every scraper once, returns a list of per-scraper results"
+        if scrapers is None:
+            scrapers = self.scrapers
+        scrapers = self.with_dependents(scrapers)
+        if self.http is not None:
+            self.http.flights.clear()
+        start = time.time()
+        results = []
+        if self.debug:
+            for scraper in self.dependency_order(scrapers):
+                results.append(self.run_one(scraper))
+        elif scrapers:
+            self.run_parallel(scrapers, results)
+        if self.batch_commits:
+            self.commit_batch(results)
+        self.push_storage()
+        self.report(results, time.time() - start)
+        return results
+
+    def run_parallel(self, scrapers, results):
+        # A scraper is queued once everything it depends on has finished,
+        # whether that succeeded or not
+        waiting = dict(
+            (scraper, set(self.upstreams(scraper, scrapers)))
+            for scraper in scrapers
+        )
+        num_workers = min(self.max_workers, len(scrapers))
+        queue = Queue.Queue()
+        lock = threading.Lock()
+        remaining = [len(scrapers)]
+
+        def finished(scraper):
+            ready = []
+            with lock:
+                remaining[0] -= 1
+                for other, upstreams in waiting.items():
+                    if scraper in upstreams:
+                        upstreams.discard(scraper)
+                        if not upstreams:
+                            ready.append(other)
+                done = not remaining[0]
+            for other in self.ordered(ready):
+                queue.put(other)
+            if done:
+                for i in range(num_workers):
+                    queue.put(None)
+
+        for scraper in self.ordered([s for s in scrapers if not waiting[s]]):
+            queue.put(scraper)
+        threads = [
+            threading.Thread(
+                target=self.worker, args=(queue, results, finished)
+            )
+            for i in range(num_workers)
+        ]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+    def push_storage(self):
+        # Storage that pushes on an interval, e.g. LocalGitRepository, gets
+        # the chance to every cycle - even one that wrote nothing
+        seen = set()
+        for scraper in self.scrapers:
+            storage = scraper.storage
+            if id(storage) in seen or not hasattr(storage, 'maybe_push'):
+                continue
+            seen.add(id(storage))
+            try:
+                storage.maybe_push()
+            except Exception, e:
+                print "!!!! Push from %s: %s !!!!!" % (
+                    scraper.__class__.__name__, e
+                )
+
+    def commit_batch(self, results):
+        "Commits every PendingWrite in results, one commit per repository"
+        by_repo = {}
+        for result in results:
+            if isinstance(result['outcome'], PendingWrite):
+                scraper = result['scraper']
+                by_repo.setdefault(
+                    (scraper.owner, scraper.repo), []
+                ).append(result)
+        for (owner, repo), repo_results in sorted(by_repo.items()):
+            pendings = [result['outcome'] for result in repo_results]
+            first = pendings[0].scraper
+            try:
+                commit_sha, blob_shas = first.storage.write_many(
+                    [
+                        (pending.filepath, pending.content, pending.scraper.last_sha)
+                        for pending in pendings
+                    ],
+                    commit_message=combined_message(pendings),
+                    committer=first.committer,
+                )
+            except Exception, e:
+                # Nothing was stored, so every scraper will try again
+                print "!!!! Batch commit to %s/%s: %s !!!!!" % (owner, repo, e)
+                for result in repo_results:
+                    result['outcome'] = None
+                    result['error'] = e
+                    # If a file changed under us its sha is out of date, so
+                    # look it up again next time
+                    result['scraper'].last_sha = None
+                for pending in pendings:
+                    pending.content.close()
+                continue
+            for result, pending in zip(repo_results, pendings):
+                # The file is committed either way, but a failing Slack post
+                # or state save mustn't stop the rest of the batch
+                try:
+                    pending.scraper.stored(
+                        pending, blob_shas[pending.filepath], commit_sha
+                    )
+                    result['outcome'] = True
+                except Exception, e:
+                    result['outcome'] = None
+                    result['error'] = e
+                    print "!!!! %s: %s !!!!!" % (
+                        pending.scraper.__class__.__name__, e
+                    )
+                    if self.debug:
+                        import pdb; pdb.post_mortem()
+
+    def report(self, results, wall_time):
+        errors = len([r for r in results if r['error'] is not None])
+        slowest = max(results, key=lambda r: r['duration']) if results else None
+        print 'Cycle took %.1fs for %d scrapers (%.1fs serial, %d error%s)%s' % (
+            wall_time,
+            len(results),
+            sum(r['duration'] for r in results),
+            errors, '' if errors == 1 else 's',
+            '; slowest was %s at %.1fs' % (
+                slowest['scraper'].__class__.__name__, slowest['duration']
+            ) if slowest else '',
+        )
+        if self.http is not None:
+            print 'HTTP: %(requests)d requests, %(connections_opened)d connections opened, %(connections_reused)d reused, %(shared_hits)d shared (%(shared_misses)d not)' % (
+                self.http.stats()
+            )
+
+
+def combined_message(pendings):
+    "A commit message covering several PendingWrites"
+    if len(pendings) == 1:
+        return pendings[0].message
+    headline = '%d files updated: %s' % (
+        len(pendings),
+        ', '.join(pending.filepath for pending in pendings),
+    )
+    return '\n\n'.join(
+        [headline] + [pending.message.strip() for pending in pendings]
+    )
+
+
+class AdaptiveScheduler(object):
+    """
+    Polls each scraper on its own interval. A scraper whose data changed is
+    polled sooner next time, one that reported "Nothing changed" is backed
+    off, within [min_interval, max_interval]. Scrapers can override those
+    bounds using their own min_interval / max_interval attributes.
+    """
+    initial_interval = 120
+    min_interval = 60
+    max_interval = 30 * 60
+    speed_up = 0.5
+    back_off = 1.5
+
+    def __init__(self, runner, initial_interval=None, min_interval=None, max_interval=None):
+        self.runner = runner
+        if initial_interval is not None:
+            self.initial_interval = initial_interval
+        if min_interval is not None:
+            self.min_interval = min_interval
+        if max_interval is not None:
+            self.max_interval = max_interval
+        self.intervals = {}
+        # Scrapers can run before they are due, as dependents of another
+        # scraper - only the latest entry for each in queue counts
+        self.next_due = {}
+        self.queue = []
+        self._counter = 0
+        now = time.time()
+        for scraper in runner.scrapers:
+            self.intervals[scraper] = self.clamp(scraper, self.initial_interval)
+            self.schedule(scraper, now)
+
+    def bounds(self, scraper):
+        min_interval = scraper.min_interval
+        max_interval = scraper.max_interval
+        return (
+            self.min_interval if min_interval is None else min_interval,
+            self.max_interval if max_interval is None else max_interval,
+        )
+
+    def clamp(self, scraper, interval):
+        min_interval, max_interval = self.bounds(scraper)
+        return max(min_interval, min(max_interval, interval))
+
+    def schedule(self, scraper, due):
+        # The counter breaks ties, so scrapers themselves are never compared
+        self._counter += 1
+        self.next_due[scraper] = due
+        heapq.heappush(self.queue, (due, self._counter, scraper))
+
+    def observe(self, scraper, outcome, error):
+        interval = self.intervals[scraper]
+        if error is not None or outcome is None:
+            # Failures tell us nothing about the change rate
+            return interval
+        if outcome:
+            interval *= self.speed_up
+        else:
+            interval *= self.back_off
+        interval = self.clamp(scraper, interval)
+        self.intervals[scraper] = interval
+        return interval
+
+    def due(self, now):
+        due = []
+        while self.queue and self.queue[0][0] <= now:
+            when, counter, scraper = heapq.heappop(self.queue)
+            if self.next_due.get(scraper) == when:
+                del self.next_due[scraper]
+                due.append(scraper)
+        return due
+
+    def run_once(self):
+        "Runs every scraper that is due, returns seconds until the next one"
+        due = self.due(time.time())
+        if due:
+            print datetime.datetime.now()
+            results = self.runner.run_cycle(due)
+            finished = time.time()
+            for result in results:
+                scraper = result['scraper']
+                interval = self.observe(
+                    scraper, result['outcome'], result['error']
+                )
+                self.schedule(scraper, finished + interval)
+        while self.queue and self.next_due.get(self.queue[0][2]) != self.queue[0][0]:
+            heapq.heappop(self.queue)
+        if not self.queue:
+            return None
+        return max(0, self.queue[0][0] - time.time())
+
+    def run_forever(self):
+        while True:
+            wait = self.run_once()
+            if wait is None:
+                return
+            time.sleep(wait)
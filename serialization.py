@@ -0,0 +1,133 @@
+"""
+Streaming serialization for the files we commit.
+
+SerializedContent JSON-encodes data a chunk at a time into a spooled
+temporary file, so the encoded document is never held in memory as one big
+string once it grows beyond spool_size. The content can then be read back in
+chunks, base64-encoded in chunks or hashed, and StreamingJSONBody wraps it up
+as a file-like HTTP request body so that requests can stream the upload too.
+
+The output is byte-for-byte identical to json.dumps(data, indent=2).
+"""
+from records import json_default
+
+import base64
+import hashlib
+import json
+import tempfile
+
+
+class SerializedContent(object):
+    chunk_size = 64 * 1024
+    # Content smaller than this stays in memory, larger spills to disk
+    spool_size = 1024 * 1024
+
+    def __init__(self, data=None, indent=2):
+        self.file = tempfile.SpooledTemporaryFile(max_size=self.spool_size)
+        self.size = 0
+        if data is not None:
+            buffered = []
+            buffered_size = 0
+            for chunk in json.JSONEncoder(
+                indent=indent, default=json_default
+            ).iterencode(data):
+                buffered.append(chunk)
+                buffered_size += len(chunk)
+                if buffered_size >= self.chunk_size:
+                    self.write(''.join(buffered))
+                    buffered = []
+                    buffered_size = 0
+            self.write(''.join(buffered))
+
+    @classmethod
+    def from_string(cls, content):
+        if isinstance(content, cls):
+            return content
+        if isinstance(content, unicode):
+            content = content.encode('utf8')
+        serialized = cls()
+        serialized.write(content)
+        return serialized
+
+    def write(self, chunk):
+        if isinstance(chunk, unicode):
+            chunk = chunk.encode('utf8')
+        self.file.write(chunk)
+        self.size += len(chunk)
+
+    def __len__(self):
+        return self.size
+
+    def chunks(self, size=None):
+        self.file.seek(0)
+        while True:
+            chunk = self.file.read(size or self.chunk_size)
+            if not chunk:
+                return
+            yield chunk
+
+    def read(self):
+        "The whole content as a string - avoid this for large files"
+        return ''.join(self.chunks())
+
+    def base64_size(self):
+        return 4 * ((self.size + 2) // 3)
+
+    def base64_chunks(self):
+        # A multiple of 3 bytes encodes without padding, so the encoded
+        # chunks can simply be concatenated
+        for chunk in self.chunks(self.chunk_size - self.chunk_size % 3):
+            yield base64.b64encode(chunk)
+
+    def git_sha(self):
+        "The sha1 git would give this content as a blob"
+        sha = hashlib.sha1('blob %d\0' % self.size)
+        for chunk in self.chunks():
+            sha.update(chunk)
+        return sha.hexdigest()
+
+    def close(self):
+        self.file.close()
+
+
+class StreamingJSONBody(object):
+    """
+    A file-like request body for a JSON object where one field holds the
+    base64-encoded content. It knows its length up front, so requests sends
+    a Content-Length and then read()s the body from here a block at a time.
+    """
+    def __init__(self, payload, field, content):
+        content = SerializedContent.from_string(content)
+        head = json.dumps(payload)
+        prefix = head[:-1] + ', ' if payload else '{'
+        self.prefix = prefix + json.dumps(field) + ': "'
+        self.suffix = '"}'
+        self.content = content
+        self.length = (
+            len(self.prefix) + content.base64_size() + len(self.suffix)
+        )
+        self._chunks = None
+        self._buffer = ''
+
+    def __len__(self):
+        return self.length
+
+    def __iter__(self):
+        yield self.prefix
+        for chunk in self.content.base64_chunks():
+            yield chunk
+        yield self.suffix
+
+    def read(self, size=-1):
+        if self._chunks is None:
+            self._chunks = iter(self)
+        while size < 0 or len(self._buffer) < size:
+            try:
+                self._buffer += next(self._chunks)
+            except StopIteration:
+                break
+        if size < 0:
+            data, self._buffer = self._buffer, ''
+        else:
+            data, self._buffer = self._buffer[:size], self._buffer[size:]
+        return data
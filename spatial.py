@@ -0,0 +1,186 @@
+"""
+Proximity searches over latitude/longitude points.
+
+GridIndex buckets points into cells at least `distance` metres across, so
+every point within that distance of another lies in the same cell or one of
+the eight around it. Finding all close pairs is then roughly linear in the
+number of points, rather than comparing every point with every other.
+
+KDTree answers "which point is nearest to here", however far away that is,
+in roughly logarithmic time.
+
+Longitude wrap-around at +/-180 is not handled; none of our datasets
+straddle it.
+"""
+from operator import itemgetter
+import math
+
+EARTH_RADIUS = 6371008.8  # metres
+METRES_PER_DEGREE = EARTH_RADIUS * math.pi / 180
+
+
+def distance(lat1, lon1, lat2, lon2):
+    "Great circle distance in metres, using the haversine formula"
+    lat1, lon1, lat2, lon2 = map(math.radians, (lat1, lon1, lat2, lon2))
+    a = (
+        math.sin((lat2 - lat1) / 2) ** 2 +
+        math.cos(lat1) * math.cos(lat2) * math.sin((lon2 - lon1) / 2) ** 2
+    )
+    return 2 * EARTH_RADIUS * math.asin(min(1, math.sqrt(a)))
+
+
+class GridIndex(object):
+    def __init__(self, points, distance):
+        "points is a list of (latitude, longitude) pairs"
+        self.points = points
+        self.distance = distance
+        self.lat_size = distance / METRES_PER_DEGREE
+        self._lon_sizes = {}
+        self.cells = {}
+        for i, (lat, lon) in enumerate(points):
+            self.cells.setdefault(self.cell(lat, lon), []).append(i)
+
+    def lon_size(self, row):
+        # A degree of longitude shrinks away from the equator, so each row
+        # of cells is sized for its edge nearest the pole
+        size = self._lon_sizes.get(row)
+        if size is None:
+            edge = max(abs(row), abs(row + 1)) * self.lat_size
+            size = self._lon_sizes[row] = self.lat_size / max(
+                math.cos(math.radians(min(edge, 89.9))), 1e-3
+            )
+        return size
+
+    def cell(self, lat, lon):
+        row = int(math.floor(lat / self.lat_size))
+        return row, int(math.floor(lon / self.lon_size(row)))
+
+    def cells_in(self, ranges):
+        "Indexes of the points in cells, given {row: (first_col, last_col)}"
+        for row, (first, last) in ranges.iteritems():
+            for col in range(first, last + 1):
+                for i in self.cells.get((row, col), ()):
+                    yield i
+
+    def pairs(self):
+        "Yields (i, j, metres) for every pair of points within distance"
+        points = self.points
+        for (row, col), members in self.cells.iteritems():
+            # Every point in a cell shares the same neighbouring cells
+            size = self.lon_size(row)
+            ranges = {}
+            for other_row in (row - 1, row, row + 1):
+                other_size = self.lon_size(other_row)
+                span = max(size, other_size)
+                ranges[other_row] = (
+                    int(math.floor((col * size - span) / other_size)),
+                    int(math.floor(((col + 1) * size + span) / other_size)),
+                )
+            candidates = list(self.cells_in(ranges))
+            for i in members:
+                lat, lon = points[i]
+                for j in candidates:
+                    if j > i:
+                        lat2, lon2 = points[j]
+                        metres = distance(lat, lon, lat2, lon2)
+                        if metres <= self.distance:
+                            yield i, j, metres
+
+
+class KDTree(object):
+    """
+    Nearest neighbour searches. Points are stored as unit vectors in three
+    dimensions, where straight-line (chord) distance orders points the same
+    way as distance over the Earth's surface, so there are no projection or
+    longitude-wrapping issues.
+    """
+    def __init__(self, points):
+        "points is a list of (latitude, longitude) pairs"
+        self.points = points
+        self.vectors = [unit_vector(lat, lon) for lat, lon in points]
+        self.root = self.build([
+            vector + (i,) for i, vector in enumerate(self.vectors)
+        ], 0)
+
+    def build(self, items, axis):
+        # items are (x, y, z, index) tuples, nodes are (index, axis, left,
+        # right) tuples
+        if not items:
+            return None
+        items.sort(key=itemgetter(axis))
+        middle = len(items) // 2
+        next_axis = (axis + 1) % 3
+        return (
+            items[middle][3],
+            axis,
+            self.build(items[:middle], next_axis),
+            self.build(items[middle + 1:], next_axis),
+        )
+
+    def nearest(self, lat, lon):
+        """
+        Returns (i, metres) for the point nearest to (lat, lon), or None if
+        there are no points.
+        """
+        target = unit_vector(lat, lon)
+        vectors = self.vectors
+        best = [None, float('inf')]
+
+        def search(node):
+            if node is None:
+                return
+            i, axis, left, right = node
+            vector = vectors[i]
+            squared = (
+                (vector[0] - target[0]) ** 2 +
+                (vector[1] - target[1]) ** 2 +
+                (vector[2] - target[2]) ** 2
+            )
+            if squared < best[1]:
+                best[0], best[1] = i, squared
+            offset = target[axis] - vector[axis]
+            near, far = (left, right) if offset < 0 else (right, left)
+            search(near)
+            if offset * offset < best[1]:
+                search(far)
+
+        search(self.root)
+        if best[0] is None:
+            return None
+        chord = math.sqrt(best[1])
+        return best[0], 2 * EARTH_RADIUS * math.asin(min(1, chord / 2))
+
+
+def unit_vector(lat, lon):
+    lat, lon = math.radians(lat), math.radians(lon)
+    return (
+        math.cos(lat) * math.cos(lon),
+        math.cos(lat) * math.sin(lon),
+        math.sin(lat),
+    )
+
+
+def connected_groups(num_points, pairs):
+    """
+    Groups points that are linked, directly or through others, by pairs.
+    Returns lists of point indexes in ascending order, leaving out points
+    that aren't in any pair.
+    """
+    parent = range(num_points)
+
+    def root(i):
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    linked = set()
+    for i, j in pairs:
+        linked.update((i, j))
+        root_i, root_j = root(i), root(j)
+        if root_i != root_j:
+            parent[max(root_i, root_j)] = min(root_i, root_j)
+    groups = {}
+    for i in sorted(linked):
+        groups.setdefault(root(i), []).append(i)
+    return sorted(groups.values())
@@ -0,0 +1,75 @@
+"""
+Local record of the last data each scraper committed. Scrapers don't hold on
+to their previous dataset; it is only decompressed from here when a change
+needs an update message, and with a directory it also means a restart doesn't
+have to read every file back from the repository before it can diff.
+
+Each entry is keyed by owner, repo and filepath and holds the blob sha of the
+committed file plus a zlib-compressed, compact JSON copy of the data. A
+scraper only trusts an entry if its sha matches the blob sha it has for the
+file, which on startup storage.blob_sha() can tell us cheaply.
+"""
+from records import json_default
+
+import hashlib
+import json
+import os
+import threading
+import zlib
+
+
+class StateStore(object):
+    def __init__(self, directory=None):
+        # With directory=None entries are only kept in memory
+        self.directory = directory
+        self._memory = {}
+        self._lock = threading.Lock()
+        if directory is not None and not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def key(self, owner, repo, filepath):
+        return '%s/%s/%s' % (owner, repo, filepath)
+
+    def path(self, key):
+        return os.path.join(
+            self.directory, hashlib.sha1(key).hexdigest() + '.state'
+        )
+
+    def save(self, owner, repo, filepath, sha, data):
+        key = self.key(owner, repo, filepath)
+        compressed = zlib.compress(
+            json.dumps(data, separators=(',', ':'), default=json_default), 6
+        )
+        with self._lock:
+            if self.directory is None:
+                self._memory[key] = (sha, compressed)
+                return
+            path = self.path(key)
+            # Write then rename, so a crash never leaves a truncated file
+            with open(path + '.tmp', 'wb') as fp:
+                fp.write(json.dumps({'key': key, 'sha': sha}) + '\n')
+                fp.write(compressed)
+            os.rename(path + '.tmp', path)
+
+    def load(self, owner, repo, filepath):
+        "Returns (sha, data), or None if there is no usable entry"
+        key = self.key(owner, repo, filepath)
+        with self._lock:
+            if self.directory is None:
+                entry = self._memory.get(key)
+            else:
+                try:
+                    with open(self.path(key), 'rb') as fp:
+                        header = json.loads(fp.readline())
+                        entry = (header['sha'], fp.read())
+                    if header['key'] != key:
+                        entry = None
+                except (IOError, ValueError, KeyError):
+                    entry = None
+        if entry is None:
+            return None
+        sha, compressed = entry
+        try:
+            return sha, json.loads(zlib.decompress(compressed))
+        except (zlib.error, ValueError):
+            return None
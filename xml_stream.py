@@ -0,0 +1,38 @@
+"""
+Incremental parsing for large XML and KML documents.
+
+iter_elements() runs iterparse over a file-like object - a temporary file,
+an entry in a zip file or a streamed response.raw - and yields elements one
+at a time as soon as their end tag has been read. Each element is cleared and
+detached from its parent once the caller has moved on, so memory use stays
+flat however big the document is.
+"""
+try:
+    from xml.etree import cElementTree as ElementTree
+except ImportError:
+    from xml.etree import ElementTree
+
+KML = '{http://www.opengis.net/kml/2.2}'
+
+
+def iter_elements(fileobj, tags):
+    """
+    Yields (element, ancestors) for every element whose tag is in tags.
+    ancestors is the list of open elements from the root down to the
+    element's parent - it changes as parsing continues, so copy it rather
+    than holding on to it.
+    """
+    if isinstance(tags, basestring):
+        tags = (tags,)
+    ancestors = []
+    for event, element in ElementTree.iterparse(fileobj, ('start', 'end')):
+        if event == 'start':
+            ancestors.append(element)
+            continue
+        ancestors.pop()
+        if element.tag in tags:
+            yield element, ancestors
+            element.clear()
+            if ancestors:
+                ancestors[-1].remove(element)
+